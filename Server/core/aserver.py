@@ -0,0 +1,224 @@
+"""
+Asyncio front end of the server. Requests are checked and run by the same check_post / handle_post /
+handle_delete as core.server, on its worker pool; this front end only reads request bodies incrementally,
+writes the replies without blocking, and can stream the paintings of a Retrieve request as soon as
+each of them is loaded.
+
+With the "Streaming: true" request header, Retrieve / BatchRetrieve respond with chunked transfer
+encoding. Image-Info then only lists the Painting-Id of each match, and each match is sent as
+8 bytes (painting length and portrait length, big-endian unsigned 32-bit integers) followed by
+the painting and the portrait.
+"""
+
+from http.client import parse_headers
+from http import HTTPStatus
+from tempfile import SpooledTemporaryFile
+from io import BytesIO
+import asyncio
+import json
+import signal
+import struct
+import time
+
+from .server import print_with_date, host_name, host_port, drain_timeout, image_cache, workers,\
+    match_faces, load_match, part_length, check_post, read_faces, max_dimension_of, error_reply,\
+    handle_post as handle_post_sync, handle_delete as handle_delete_sync, start_services, stop_services
+
+chunk_size = 64 * 1024
+max_header_size = 64 * 1024
+spool_size = 1024 * 1024  # request bodies larger than this are spooled to disk
+
+
+class Request(object):
+    def __init__(self, method, headers, reader):
+        self.method = method
+        self.headers = headers
+        self.reader = reader
+        self.remaining = int(headers["Content-Length"]) if "Content-Length" in headers else 0
+
+    async def chunks(self):
+        while self.remaining:
+            chunk = await self.reader.read(min(self.remaining, chunk_size))
+            if not chunk:
+                raise ConnectionError("Connection closed while reading body")
+            self.remaining -= len(chunk)
+            yield chunk
+
+    async def read(self):
+        return b"".join([chunk async for chunk in self.chunks()])
+
+    async def spool(self):
+        body = SpooledTemporaryFile(max_size=spool_size)
+        async for chunk in self.chunks():
+            body.write(chunk)
+        body.seek(0)
+        return body
+
+    async def discard(self):
+        async for _ in self.chunks():
+            pass
+
+
+class Response(object):
+    def __init__(self, writer):
+        self.writer = writer
+        self.chunked = False
+        self.started = False
+
+    async def start(self, code, content_type="application/json", extra_info=None, chunked=False, length=0):
+        self.chunked, self.started = chunked, True
+        lines = [f"HTTP/1.1 {code} {HTTPStatus(code).phrase}", f"Content-Type: {content_type}"]
+        lines += [f"{key}: {value}" for key, value in (extra_info or {}).items()]
+        lines.append("Transfer-Encoding: chunked" if chunked else f"Content-Length: {length}")
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await self.writer.drain()
+
+    async def write(self, part):
+        length = part_length(part)
+        if self.chunked:
+            self.writer.write(f"{length:x}\r\n".encode("latin-1"))
+        if isinstance(part, str):
+            with open(part, "rb") as f:
+                await asyncio.get_event_loop().sendfile(self.writer.transport, f)
+        else:
+            self.writer.write(part)
+        if self.chunked:
+            self.writer.write(b"\r\n")
+        await self.writer.drain()
+
+    async def finish(self):
+        if self.chunked:
+            self.writer.write(b"0\r\n\r\n")
+            await self.writer.drain()
+
+
+async def respond(response, reply):
+    await response.start(reply.code, reply.content_type, reply.extra_info,
+                         length=sum(part_length(part) for part in reply.parts))
+    for part in reply.parts:
+        await response.write(part)
+
+
+async def stream_matches(response, matches, max_dimension, single_face):
+    info = [[{"Painting-Id": painting_id} for _, painting_id in face_matches] for face_matches in matches]
+    # the same shape as the Image-Info of a buffered response, not nested for a single face
+    info = info[0] if single_face else info
+    await response.start(200, "application/octet-stream", {"Image-Info": json.dumps(info)}, chunked=True)
+    loop = asyncio.get_event_loop()
+    for face_matches in matches:
+        for face_id, painting_id in face_matches:
+            # loading may encode the images, which is done off the event loop
+            original, face = await loop.run_in_executor(None, load_match, face_id, painting_id, max_dimension)
+            await response.write(struct.pack(">II", part_length(original), part_length(face)))
+            await response.write(original)
+            await response.write(face)
+    await response.finish()
+    print_with_date(f"Image cache {image_cache.stats()}")
+
+
+def match_streamed(headers, body):
+    # decoding the faces runs on the worker too
+    return match_faces(read_faces(headers, body))
+
+
+async def handle_post(request, response):
+    headers = request.headers
+    code = check_post(headers)
+    if code is not None:
+        await response.start(code)
+        return
+
+    body = await request.spool()
+    operation = headers["Operation"]
+    if operation in ("Retrieve", "BatchRetrieve") and headers.get("Streaming", "").lower() == "true":
+        matches = await asyncio.wrap_future(workers.submit(match_streamed, headers, body))
+        await stream_matches(response, matches, max_dimension_of(headers), operation == "Retrieve")
+    else:
+        await respond(response, await asyncio.wrap_future(workers.submit(handle_post_sync, headers, body)))
+
+
+async def handle_delete(request, response):
+    await response.start(await asyncio.get_event_loop().run_in_executor(None, handle_delete_sync, request.headers))
+
+
+class AsyncServer(object):
+    def __init__(self):
+        # connection task -> whether it is handling a request, idle keep-alive connections are not waited for
+        self.connections = {}
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task() if hasattr(asyncio, "current_task") else asyncio.Task.current_task()
+        self.connections[task] = False
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                self.connections[task] = True
+                request, response = None, Response(writer)
+                start_time = time.time()
+                try:
+                    request_line, _, header_lines = head.partition(b"\r\n")
+                    method, _, version = request_line.decode("latin-1").split(" ", 2)
+                    headers = parse_headers(BytesIO(header_lines))
+                    keep_alive = version == "HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+                    request = Request(method, headers, reader)
+                    print_with_date(f"Receive a {method} request")
+
+                    if method == "POST":
+                        await handle_post(request, response)
+                    elif method == "DELETE":
+                        await handle_delete(request, response)
+                    else:
+                        await response.start(501)
+                except (ConnectionError, asyncio.CancelledError):
+                    raise
+                except Exception as err:
+                    reply = error_reply(err)
+                    # a response already started cannot change its status, the connection is closed instead
+                    if response.started:
+                        break
+                    await response.start(reply.code, extra_info=reply.extra_info)
+                    # the rest of the body may be malformed too, only requests turned away as too many keep it open
+                    keep_alive = keep_alive and request is not None and reply.code == 429
+                if keep_alive:
+                    # leave the connection ready for the next request if the body was not consumed
+                    await request.discard()
+                print_with_date("Response sent")
+                print_with_date(f"Elapsed time {time.time() - start_time:.3f}s")
+                self.connections[task] = False
+        except ConnectionError as err:
+            print_with_date(f"Connection lost: {err}")
+        except asyncio.CancelledError:
+            pass  # idle keep-alive connection closed on shutdown
+        finally:
+            writer.close()
+            self.connections.pop(task, None)
+
+    async def serve(self, stopped):
+        server = await asyncio.start_server(self.handle_connection, host_name or None, host_port,
+                                            limit=max_header_size)
+        await stopped.wait()
+
+        server.close()
+        [task.cancel() for task, busy in list(self.connections.items()) if not busy]
+        busy = [task for task, busy in self.connections.items() if busy]
+        if busy:
+            print_with_date("Waiting for requests in flight")
+            _, pending = await asyncio.wait(busy, timeout=drain_timeout)
+            if pending:
+                print_with_date(f"Requests still in flight after {drain_timeout}s")
+        await server.wait_closed()
+        print_with_date("Server stopped")
+
+
+if __name__ == "__main__":
+    zeroconf, info = start_services(host_port)
+    loop = asyncio.get_event_loop()
+    stopped = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    loop.run_until_complete(AsyncServer().serve(stopped))
+    stop_services(zeroconf, info)
@@ -0,0 +1,135 @@
+from collections import OrderedDict, defaultdict
+from threading import Lock, get_ident
+import glob
+import hashlib
+import os
+
+__all__ = ["ByteCache", "StylizedCache"]
+
+
+class ByteCache(object):
+    """
+    LRU cache of bytes values with a budget on their total length. Values are produced by the loader
+    given to get on the first miss, and the least recently used ones are evicted once over budget.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, loader=None):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+
+        if loader is None:
+            return None
+        # load outside the lock, concurrent misses on the same key may load it twice
+        value = loader()
+        self.put(key, value)
+        return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            # a value larger than the whole budget is returned to the caller but never stored
+            if len(value) > self.capacity:
+                return
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.capacity:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.size -= len(value)
+            return value
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "hit_rate": self.hits / total if total else 0.0,
+                    "entries": len(self.entries),
+                    "size": self.size}
+
+
+class StylizedCache(object):
+    """
+    Encoded stylized photos, keyed by the content of the stored photo, the style and the output size.
+    Recent results are kept in memory within capacity bytes, and every result is also written under
+    directory, so that evicted ones are read back from disk instead of being transferred again.
+    """
+
+    def __init__(self, directory, capacity):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.memory = ByteCache(capacity)
+        self.photo_keys = defaultdict(set)
+        self.lock = Lock()
+
+    @staticmethod
+    def content_hash(photo_path):
+        with open(photo_path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    @staticmethod
+    def key(content_hash, style_index, size, preview=False):
+        # previews may come from another model, so they never share a key with full results of the same size
+        return f"{content_hash}_{style_index}_{size[0]}x{size[1]}" + ("_preview" if preview else "")
+
+    def __contains__(self, key):
+        return key in self.memory or os.path.isfile(os.path.join(self.directory, f"{key}.jpg"))
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is not None:
+            return value
+        path = os.path.join(self.directory, f"{key}.jpg")
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as f:
+            value = f.read()
+        self.remember(key, value)
+        return value
+
+    def put(self, key, value):
+        path = os.path.join(self.directory, f"{key}.jpg")
+        # write then rename, so that a concurrent get never reads a partial file
+        tmp_path = f"{path}.{get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(value)
+        os.rename(tmp_path, path)
+        self.remember(key, value)
+
+    def remember(self, key, value):
+        with self.lock:
+            self.photo_keys[key.split("_")[0]].add(key)
+        self.memory.put(key, value)
+
+    def invalidate(self, content_hash):
+        with self.lock:
+            keys = self.photo_keys.pop(content_hash, set())
+        [self.memory.pop(key) for key in keys]
+        for path in glob.glob(os.path.join(self.directory, f"{content_hash}_*.jpg")):
+            os.remove(path)
@@ -1,23 +1,83 @@
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
+
+from .index import backends
 
 
 class Comparator(object):
-    def __init__(self, train_data, neighbors):
-        self.train_data = train_data
-        self.neighbors = NearestNeighbors(metric=self.construct_metric([9.0, 5.0, 0.7, 9.3, 8.0, 10.0]),
-                                          n_neighbors=neighbors).fit(train_data)
+    default_weight = [9.0, 5.0, 0.7, 9.3, 8.0, 10.0]
+
+    def __init__(self, train_data, neighbors, weight=None, backend="exact", prescaled=False, **backend_args):
+        # sqrt(sum(w * (x1 - x2) ^ 2)) equals the plain euclidean distance between sqrt(w) * x1 and sqrt(w) * x2,
+        # so the landmarks are scaled once here and the index backend only needs a euclidean search
+        self.neighbors, self.weight = neighbors, weight
+        self.backend, self.backend_args = backend, backend_args
+        self.scale = np.sqrt(self.construct_weight(self.default_weight if weight is None else weight))
+        # prescaled train_data has already been multiplied by self.scale
+        self.train_data = np.asarray(train_data, dtype=np.float64)
+        if not prescaled:
+            self.train_data = np.multiply(self.train_data, self.scale)
+        self.appended = []
+        self.index = backends[backend](neighbors, **backend_args).fit(self.train_data)
+
+    def __len__(self):
+        return len(self.train_data) + sum(len(data) for data in self.appended)
+
+    def append(self, landmarks, prescaled=False):
+        # new rows get the indices following the existing ones, only the new rows are processed
+        scaled = np.asarray(landmarks, dtype=np.float64)
+        if not prescaled:
+            scaled = np.multiply(scaled, self.scale)
+        self.appended.append(scaled)
+        self.index.add(scaled)
+
+    def scaled_data(self, start=0):
+        chunks, offset = [], 0
+        for chunk in [self.train_data] + self.appended:
+            if offset + len(chunk) > start:
+                chunks.append(chunk[max(start - offset, 0):])
+            offset += len(chunk)
+        return np.vstack(chunks) if chunks else np.empty((0, len(self.scale)))
+
+    def needs_rebuild(self):
+        return self.index.needs_rebuild()
+
+    def rebuild(self, data=None):
+        # returns a new comparator fitted on data, all the rows by default, leaving this one usable until it is replaced
+        return Comparator(self.scaled_data() if data is None else data, self.neighbors, self.weight,
+                          self.backend, prescaled=True, **self.backend_args)
 
     def __call__(self, landmarks):
-        return self.neighbors.kneighbors([landmarks], return_distance=False)[0]
+        return self.batch([landmarks])[0]
+
+    def batch(self, landmarks):
+        return self.index.query(np.multiply(landmarks, self.scale))
 
     @staticmethod
-    def construct_metric(weight):
+    def construct_weight(weight):
         landmark_weight = sum([[weight[i]] * point_count
                                for i, point_count in enumerate([17, 10, 9, 12, 12, 8])], [])
-        landmark_weight = np.array(landmark_weight * 2)
+        return np.array(landmark_weight * 2)
+
+    @staticmethod
+    def construct_metric(weight):
+        landmark_weight = Comparator.construct_weight(weight)
 
         def metric(x1, x2):
             return np.sqrt(np.sum(np.multiply(np.square(np.subtract(x1, x2)), landmark_weight)))
 
         return metric
+
+
+def match_batch(comparators, landmarks, emotion_ids):
+    """
+    Query each row of landmarks (N, 136) against the comparator of its emotion.
+    Rows are grouped by emotion so that every comparator is queried only once.
+    Returns a list of N index arrays, in the same order as the input rows.
+    """
+    landmarks, emotion_ids = np.asarray(landmarks), np.asarray(emotion_ids)
+    matches = [None] * len(emotion_ids)
+    for emotion_id in np.unique(emotion_ids):
+        rows = np.flatnonzero(emotion_ids == emotion_id)
+        for row, indices in zip(rows, comparators[emotion_id].batch(landmarks[rows])):
+            matches[row] = indices
+    return matches
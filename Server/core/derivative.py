@@ -0,0 +1,65 @@
+from multiprocessing import cpu_count
+import glob
+import os
+import sys
+
+from PIL import Image
+
+from .pool import ProcessPool
+from database import paintings_dir, faces_dir, derivative_dir
+
+__all__ = ["tiers", "build_derivatives", "find_derivative"]
+
+# (maximum length of the longer side, jpeg quality), smaller tiers are compressed harder
+tiers = [(256, 70), (512, 80), (1024, 85)]
+
+
+def derivative_path(target_dir, name, size):
+    return os.path.join(target_dir, f"{name}_{size}.jpg")
+
+
+def render(img_file, shared):
+    target_dir = shared["target_dir"]
+    name = os.path.splitext(os.path.basename(img_file))[0]
+    try:
+        image = None
+        for size, quality in tiers:
+            path = derivative_path(target_dir, name, size)
+            if os.path.isfile(path):
+                continue
+            if image is None:
+                image = Image.open(img_file).convert("RGB")
+            resized = image.copy()
+            resized.thumbnail((size, size), Image.ANTIALIAS)  # keeps the aspect ratio, never enlarges
+            # write then rename, so that the server never sends a partially written file
+            resized.save(path + ".tmp", format="jpeg", quality=quality, optimize=True)
+            os.rename(path + ".tmp", path)
+    except OSError as err:
+        print(f"Failed to render {img_file}: {err}")
+
+
+def build_derivatives(source_dir, target_dir, num_process=cpu_count()):
+    """
+    Render every image of source_dir at each tier into target_dir. Existing files are skipped,
+    so this can be rerun after new paintings are crawled.
+    """
+    if not os.path.exists(target_dir):
+        os.makedirs(target_dir)
+    files = sorted(glob.glob(os.path.join(source_dir, "*.jpg")))
+    print(f"Rendering {len(files)} images from {source_dir}")
+    pool = ProcessPool(num_process, render, files, {"target_dir": target_dir})
+    pool.join()
+
+
+def find_derivative(target_dir, name, max_dimension):
+    # the largest tier fitting in max_dimension, or the smallest one if none fits
+    fitting = [size for size, _ in tiers if size <= max_dimension]
+    size = max(fitting) if fitting else min(size for size, _ in tiers)
+    path = derivative_path(target_dir, name, size)
+    return path if os.path.isfile(path) else None
+
+
+if __name__ == "__main__":
+    num_process = int(sys.argv[1]) if len(sys.argv) > 1 else cpu_count()
+    build_derivatives(paintings_dir, os.path.join(derivative_dir, "paintings"), num_process)
+    build_derivatives(faces_dir, os.path.join(derivative_dir, "faces"), num_process)
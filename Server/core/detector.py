@@ -86,29 +86,46 @@ class LandmarksDetector:
 
     def __call__(self, img, xlo, ylo, xhi, yhi):
         bbox = Rectangle(xlo, ylo, xhi, yhi)
-        landmarks = ([point.x, point.y] for point in self.predictor(img, bbox).parts())
+        landmarks = [[point.x, point.y] for point in self.predictor(img, bbox).parts()]
         return np.array(landmarks, dtype=np.float)
 
+    # per point, the index of the leftmost and rightmost points of its region,
+    # and the matrix averaging the points of its region
+    region_left = np.concatenate([[left] * (end - start) for _, (start, end), (left, _) in landmark_map])
+    region_right = np.concatenate([[right] * (end - start) for _, (start, end), (_, right) in landmark_map])
+    region_ids = np.concatenate([[i] * (end - start) for i, (_, (start, end), _) in enumerate(landmark_map)])
+    region_mean = np.equal.outer(region_ids, region_ids) / np.bincount(region_ids)[region_ids].reshape(68, 1)
+
     @classmethod
     def normalize_landmarks(cls, landmarks):
-        landmarks = np.copy(landmarks).transpose()
-        for _, (start, end), (left, right) in cls.landmark_map:
-            leftmost, rightmost = left - start, right - start
-            points = landmarks[:, start: end]
-            # let the x coordinate of the leftmost point be 0.0
-            # let the mean of y coordinates of all points be 0.0
-            points -= np.array([points[0][leftmost], np.mean(points[1, :])]).reshape(2, 1)
-            # let the x coordinate of the rightmost point be 2.0
-            # scale all y coordinates at the same time with the same ratio
-            points *= 2.0 / points[0][rightmost]
-            # let the x coordinate of the leftmost point be -1.0, and that of the rightmost be 1.0
-            points[0, :] -= 1.0
-        return np.hstack([landmarks[0, :], landmarks[1, :]])
+        return cls.normalize_landmarks_batch(np.asarray(landmarks)[None])[0]
+
+    @classmethod
+    def normalize_landmarks_batch(cls, landmarks):
+        """
+        landmarks has shape (n, 68, 2), returns the normalized x coordinates followed by the y coordinates,
+        of shape (n, 136). Within each region of landmark_map, the x coordinates of its leftmost and
+        rightmost points become -1.0 and 1.0, and the mean of its y coordinates 0.0, with the same scale.
+        """
+        x, y = landmarks[:, :, 0].astype(np.float64), landmarks[:, :, 1].astype(np.float64)
+        x_left = x[:, cls.region_left]
+        scale = 2.0 / (x[:, cls.region_right] - x_left)
+        return np.hstack([(x - x_left) * scale - 1.0,
+                          (y - np.dot(y, cls.region_mean.T)) * scale])
 
     @classmethod
     def pose_landmarks(cls, landmarks):
-        source_points = landmarks[cls.transform_base].transpose()
-        source_matrix = np.vstack([source_points, np.ones([1, 3])])
-        rotation_matrix = np.dot(cls.target_matrix, np.linalg.inv(source_matrix))[0:2, 0:2]
-        posed = np.dot(rotation_matrix, landmarks.transpose())
-        return cls.normalize_landmarks(posed.transpose())
+        return cls.pose_landmarks_batch(np.asarray(landmarks)[None])[0]
+
+    @classmethod
+    def pose_landmarks_batch(cls, landmarks):
+        # the affine transform taking the outer eyes and bottom lips of each face to those of the model,
+        # whose linear part is applied to all points before normalizing
+        source_matrix = np.concatenate([landmarks[:, cls.transform_base].transpose(0, 2, 1),
+                                        np.ones([len(landmarks), 1, 3])], axis=1)
+        # target_matrix . inv(source_matrix) = solve(source_matrix^T, target_matrix^T)^T
+        transform = np.linalg.solve(source_matrix.transpose(0, 2, 1),
+                                    np.broadcast_to(cls.target_matrix.T, source_matrix.shape))
+        rotation_matrix = transform.transpose(0, 2, 1)[:, 0:2, 0:2]
+        posed = np.matmul(landmarks, rotation_matrix.transpose(0, 2, 1))
+        return cls.normalize_landmarks_batch(posed)
@@ -0,0 +1,117 @@
+"""
+Offline landmark extraction of the emotion dataset into the model database.
+
+Image paths are streamed in chunks through a process pool, whose workers each load their own shape predictor.
+Chunks come back in order, and the landmarks of each are normalized and inserted in bulk, then committed
+together with a checkpoint, so that an interrupted run resumes after the last committed chunk.
+
+The split is deterministic: for each emotion, the first 20% of the sorted files go to Test, the rest to Training,
+and all of them to Total. Delete the checkpoint in the dataset directory to extract again from scratch.
+"""
+
+from multiprocessing import Pool, cpu_count
+import glob
+import json
+import os
+import sys
+
+import numpy as np
+from skimage import io
+
+from .detector import LandmarksDetector
+from database import ModelDatabaseHandler, dataset_dir, emotions
+
+__all__ = ["build_database"]
+
+chunk_size = 64  # images per task of the pool, and per bulk insert
+test_ratio = 0.2
+branches = ["Training", "Test", "Total"]
+checkpoint_name = "extraction.json"
+
+_detector = None  # one per worker process
+
+
+def init_worker():
+    global _detector
+    _detector = LandmarksDetector()
+
+
+def extract_chunk(task):
+    emotion_id, start, img_files = task
+    landmarks = []
+    for img_file in img_files:
+        try:
+            img_data = io.imread(img_file)
+            landmarks.append(_detector(img_data, 0, 0, img_data.shape[1], img_data.shape[0]))
+        except (OSError, ValueError, RuntimeError) as err:
+            print("Failed to process {}: {}".format(img_file, err))
+            landmarks.append(None)
+    return emotion_id, start, landmarks
+
+
+def load_checkpoint(path):
+    if not os.path.isfile(path):
+        return {"done": {emotion: 0 for emotion in emotions}, "last_ids": None}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path, checkpoint):
+    with open(path + ".tmp", "w") as f:
+        json.dump(checkpoint, f)
+    os.rename(path + ".tmp", path)
+
+
+def build_database(directory=dataset_dir, num_process=cpu_count()):
+    checkpoint_path = os.path.join(directory, checkpoint_name)
+    checkpoint = load_checkpoint(checkpoint_path)
+    db_handler = ModelDatabaseHandler()
+
+    if checkpoint["last_ids"] is None:
+        # written before the first chunk is committed, so that a crash after it still resumes from here
+        checkpoint["last_ids"] = {branch: db_handler.get_last_id(branch) for branch in branches}
+        save_checkpoint(checkpoint_path, checkpoint)
+    else:
+        # rows committed after the last checkpoint was written would be inserted again, remove them
+        removed = sum(db_handler.delete_after(branch, last_id) for branch, last_id in checkpoint["last_ids"].items())
+        db_handler.commit()
+        print("Resuming from {}, {} uncheckpointed rows removed".format(checkpoint["done"], removed))
+
+    tasks, totals = [], {}
+    for emotion_id, emotion in enumerate(emotions):
+        files = sorted(glob.glob(os.path.join(directory, emotion, "*.jpg")))
+        totals[emotion_id] = len(files)
+        tasks += [(emotion_id, start, files[start: start + chunk_size])
+                  for start in range(checkpoint["done"][emotion], len(files), chunk_size)]
+    print("{} chunks to process".format(len(tasks)))
+
+    with Pool(num_process, initializer=init_worker) as pool:
+        for emotion_id, start, landmarks in pool.imap(extract_chunk, tasks):
+            rows = {branch: [] for branch in branches}
+            num_test = int(totals[emotion_id] * test_ratio)
+            indices = [index for index, points in enumerate(landmarks, start) if points is not None]
+            detected = np.array([points for points in landmarks if points is not None]).reshape(-1, 68, 2)
+            normalized = LandmarksDetector.normalize_landmarks_batch(detected).tolist()
+            posed = LandmarksDetector.pose_landmarks_batch(detected).tolist()
+            for index, row in zip(indices, zip([emotion_id] * len(indices), normalized, posed)):
+                rows["Test" if index < num_test else "Training"].append(row)
+                rows["Total"].append(row)
+
+            # the rows of all branches are committed together, then the checkpoint is written
+            for branch in branches:
+                writer = db_handler.landmark_writer(branch, commit=False)
+                [writer.add(*row) for row in rows[branch]]
+                writer.flush()
+            db_handler.commit()
+
+            emotion = emotions[emotion_id]
+            checkpoint["done"][emotion] = start + len(landmarks)
+            checkpoint["last_ids"] = {branch: db_handler.get_last_id(branch) for branch in branches}
+            save_checkpoint(checkpoint_path, checkpoint)
+            print("{}: processed ({}/{})".format(emotion, checkpoint["done"][emotion], totals[emotion_id]))
+
+    db_handler.close()
+
+
+if __name__ == "__main__":
+    build_database(num_process=int(sys.argv[1]) if len(sys.argv) > 1 else cpu_count())
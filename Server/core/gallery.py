@@ -0,0 +1,219 @@
+from threading import Lock, Thread, Event
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from .comparator import Comparator, match_batch
+from database import PaintingDatabaseHandler, emotions, gallery_dir
+
+__all__ = ["PaintingGallery"]
+
+
+class PaintingGallery(object):
+    """
+    Per-emotion comparators over the painting landmarks, kept in sync with the Landmark table.
+    refresh only loads the rows whose id is larger than the last loaded one and appends them to the
+    comparators; comparators that degraded after many appends are rebuilt in the background.
+
+    export writes the scaled landmarks, grouped by emotion, to .npy files that load maps read-only,
+    so that the server starts without querying and parsing the whole table, and several server
+    processes on the same machine share the pages of the file.
+    """
+
+    file_version = 1
+
+    def __init__(self, neighbors, backend="exact", backend_args=None):
+        self.neighbors = neighbors
+        self.backend, self.backend_args = backend, backend_args or {}
+        # the gallery owns its handler, since refresh may run on the polling thread
+        self.db_handler = PaintingDatabaseHandler()
+        self.lock = Lock()
+        self.refresh_lock = Lock()
+        self.painting_map = [[] for _ in range(len(emotions))]
+        self.comparators = [None] * len(emotions)
+        self.rebuilding = set()
+        self.last_id = 0
+        self.polling = None
+
+    def __len__(self):
+        return sum(len(mapping) for mapping in self.painting_map)
+
+    def refresh(self):
+        with self.refresh_lock:
+            try:
+                ids, painting_ids, emotion_ids, points = self.db_handler.load_landmarks(self.last_id)
+            finally:
+                # refresh runs on request and polling threads, which should not each hold a connection
+                self.db_handler.release()
+            if not len(ids):
+                return 0
+
+            selected = [emotion_ids == eid for eid in range(len(emotions))]
+            new_map = [np.stack([ids[mask], painting_ids[mask]], axis=1).tolist() for mask in selected]
+            new_landmarks = [points[mask] for mask in selected]
+
+            # build the comparators of emotions seen for the first time outside the lock
+            created = [Comparator(points, self.neighbors, backend=self.backend, **self.backend_args)
+                       if len(points) and self.comparators[eid] is None else None
+                       for eid, points in enumerate(new_landmarks)]
+
+            with self.lock:
+                for eid, (mapping, points) in enumerate(zip(new_map, new_landmarks)):
+                    if not len(points):
+                        continue
+                    if created[eid] is not None:
+                        self.comparators[eid] = created[eid]
+                    else:
+                        self.comparators[eid].append(points)
+                    # rebound rather than extended, match reads the maps outside the lock
+                    self.painting_map[eid] = self.painting_map[eid] + mapping
+                self.last_id = int(ids[-1])
+
+            for eid, comparator in enumerate(self.comparators):
+                if comparator is not None and comparator.needs_rebuild():
+                    self.compact(eid)
+            return len(ids)
+
+    def compact(self, emotion_id, background=True):
+        if emotion_id in self.rebuilding:
+            return
+        self.rebuilding.add(emotion_id)
+
+        def rebuild():
+            try:
+                with self.lock:
+                    comparator = self.comparators[emotion_id]
+                    data = comparator.scaled_data()
+                rebuilt = comparator.rebuild(data)
+                with self.lock:
+                    # rows appended while rebuilding only exist in the old comparator
+                    current = self.comparators[emotion_id]
+                    if len(current) > len(data):
+                        rebuilt.append(current.scaled_data(len(data)), prescaled=True)
+                    self.comparators[emotion_id] = rebuilt
+                print(f"{time.asctime()} Comparator of {emotions[emotion_id]} rebuilt with {len(rebuilt)} paintings")
+            finally:
+                self.rebuilding.discard(emotion_id)
+
+        if background:
+            Thread(target=rebuild, daemon=True).start()
+        else:
+            rebuild()
+
+    def start_polling(self, interval):
+        stopped = Event()
+
+        def poll():
+            while not stopped.wait(interval):
+                added = self.refresh()
+                if added:
+                    print(f"{time.asctime()} {added} new paintings added to gallery")
+
+        self.polling = stopped
+        Thread(target=poll, daemon=True).start()
+
+    def stop_polling(self):
+        if self.polling is not None:
+            self.polling.set()
+            self.polling = None
+
+    def match(self, landmarks, emotion_ids):
+        # returns a list of (landmark id, painting id) pairs for each row of landmarks
+        with self.lock:
+            comparators = list(self.comparators)
+        # the search runs outside the lock, appends to a comparator only add rows after those it returns
+        matches = match_batch(comparators, landmarks, emotion_ids)
+        with self.lock:
+            # read after the search, the maps cover every row the comparators held during it
+            painting_map = list(self.painting_map)
+        return [[painting_map[emotion_id][idx] for idx in indices]
+                for emotion_id, indices in zip(emotion_ids, matches)]
+
+    def export(self, directory=gallery_dir):
+        with self.lock:
+            partitions = [comparator.scaled_data() if comparator is not None else np.empty((0, 136))
+                          for comparator in self.comparators]
+            ids = np.array(sum(self.painting_map, []), dtype=np.int64).reshape(-1, 2)
+            last_id = self.last_id
+        landmarks = np.ascontiguousarray(np.vstack(partitions))
+        offsets = np.cumsum([0] + [len(partition) for partition in partitions])
+
+        # write to a sibling directory first, so that a running server never maps a half written file
+        tmp_dir = directory.rstrip(os.sep) + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, "landmarks.npy"), landmarks)
+        np.save(os.path.join(tmp_dir, "ids.npy"), ids)
+        np.save(os.path.join(tmp_dir, "offsets.npy"), offsets)
+        manifest = {"version": self.file_version,
+                    "weight": Comparator.default_weight,
+                    "count": len(ids),
+                    "last_id": last_id,
+                    "checksum": self.checksum(landmarks, ids)}
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f)
+
+        shutil.rmtree(directory, ignore_errors=True)
+        os.rename(tmp_dir, directory)
+        print(f"{time.asctime()} Gallery of {len(ids)} paintings exported to {directory}")
+
+    def load(self, directory=gallery_dir, verify=False):
+        """
+        Map an exported gallery. Returns False if the file is missing, was exported by another
+        version or with other weights, or if the number of rows up to its last id changed in the database.
+        Rows changed in place up to the last id are not detected, export again after updating them.
+        verify checksums the file against its manifest, which reads every page of it.
+        Rows inserted after the export are not loaded here, call refresh to append them.
+
+        The exact backend searches the mapped rows by brute force unless another algorithm is given,
+        since a sklearn tree would copy them and the pages would no longer be shared between processes.
+        """
+        manifest_path = os.path.join(directory, "manifest.json")
+        if not os.path.isfile(manifest_path):
+            return False
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["version"] != self.file_version or manifest["weight"] != Comparator.default_weight:
+            print(f"{time.asctime()} Gallery file {directory} is outdated")
+            return False
+        if self.db_handler.count_landmarks(manifest["last_id"]) != manifest["count"]:
+            print(f"{time.asctime()} Gallery file {directory} does not match the database")
+            return False
+
+        landmarks = np.load(os.path.join(directory, "landmarks.npy"), mmap_mode="r")
+        ids = np.load(os.path.join(directory, "ids.npy"), mmap_mode="r")
+        offsets = np.load(os.path.join(directory, "offsets.npy"))
+        if verify and self.checksum(landmarks, ids) != manifest["checksum"]:
+            print(f"{time.asctime()} Gallery file {directory} is corrupted")
+            return False
+
+        backend_args = dict(self.backend_args)
+        if self.backend == "exact":
+            backend_args.setdefault("algorithm", "brute")
+        with self.refresh_lock, self.lock:
+            for eid, (begin, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+                self.comparators[eid] = Comparator(landmarks[begin: end], self.neighbors, backend=self.backend,
+                                                   prescaled=True, **backend_args) if end > begin else None
+                self.painting_map[eid] = ids[begin: end].tolist()
+            self.last_id = manifest["last_id"]
+        print(f"{time.asctime()} Gallery of {manifest['count']} paintings loaded from {directory}")
+        return True
+
+    @staticmethod
+    def checksum(landmarks, ids):
+        sha1 = hashlib.sha1()
+        sha1.update(np.ascontiguousarray(ids).data)
+        sha1.update(np.ascontiguousarray(landmarks).data)
+        return sha1.hexdigest()
+
+
+if __name__ == "__main__":
+    # python -m core.gallery [directory]: export the paintings in the database for the server to map
+    gallery = PaintingGallery(3)
+    gallery.refresh()
+    gallery.export(sys.argv[1] if len(sys.argv) > 1 else gallery_dir)
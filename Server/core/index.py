@@ -0,0 +1,194 @@
+import time
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+__all__ = ["ExactIndex", "IVFIndex", "backends", "benchmark_backends"]
+
+
+def squared_distances(queries, data):
+    # ||q - x||^2 = ||q||^2 - 2 q.x + ||x||^2, computed with one matrix product
+    distances = np.square(queries).sum(axis=1)[:, None] - 2.0 * np.dot(queries, data.T) + np.square(data).sum(axis=1)
+    return np.maximum(distances, 0.0)
+
+
+class ExactIndex(object):
+    """
+    Exact search with a sklearn tree over the data given to fit. Rows given to add are kept in a delta
+    buffer that is scanned by brute force, until it grows past rebuild_ratio of the tree.
+    """
+
+    def __init__(self, neighbors, rebuild_ratio=0.2, algorithm="auto"):
+        self.neighbors = neighbors
+        self.rebuild_ratio = rebuild_ratio
+        # "brute" searches the data in place instead of copying it into a tree
+        self.algorithm = algorithm
+
+    def fit(self, data):
+        self.base_size = len(data)
+        self.searcher = NearestNeighbors(n_neighbors=min(self.neighbors, self.base_size),
+                                         algorithm=self.algorithm).fit(data)
+        self.delta = np.empty((0, np.shape(data)[1]))
+        return self
+
+    def add(self, data):
+        self.delta = np.vstack([self.delta, data])
+
+    def needs_rebuild(self):
+        return len(self.delta) > self.rebuild_ratio * self.base_size
+
+    def query(self, queries):
+        # add rebinds the delta, which may happen during a query
+        delta = self.delta
+        if not len(delta):
+            return self.searcher.kneighbors(queries, return_distance=False)
+
+        distances, ids = self.searcher.kneighbors(queries)
+        distances = np.hstack([np.square(distances), squared_distances(np.asarray(queries), delta)])
+        ids = np.hstack([ids, np.broadcast_to(self.base_size + np.arange(len(delta)), (len(ids), len(delta)))])
+        nearest = np.argsort(distances, axis=1, kind="stable")[:, :self.neighbors]
+        return np.take_along_axis(ids, nearest, axis=1)
+
+
+class IVFIndex(object):
+    """
+    Inverted file index: the data is clustered by k-means into n_lists cells, and a query only scans the
+    n_probe cells whose centroids are closest to it. Larger n_probe trades latency for recall,
+    and n_probe == n_lists degrades to an exact search. Rows given to add are appended to the cell
+    of their closest centroid; the centroids go stale once the data grows past rebuild_ratio.
+    """
+
+    def __init__(self, neighbors, n_lists=None, n_probe=8, n_iter=10, sample_size=256, seed=0,
+                 rebuild_ratio=0.5):
+        self.neighbors = neighbors
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.sample_size = sample_size
+        self.seed = seed
+        self.rebuild_ratio = rebuild_ratio
+
+    def fit(self, data):
+        self.data = np.asarray(data, dtype=np.float64)
+        n_lists = self.n_lists or max(1, int(np.sqrt(len(self.data))))
+        self.centroids = self.train_centroids(min(n_lists, len(self.data)))
+        self.base_size = len(self.data)
+        self.lists = self.split_lists(self.assign(self.data), 0)
+        return self
+
+    def add(self, data):
+        data = np.asarray(data, dtype=np.float64)
+        added = self.split_lists(self.assign(data), len(self.data))
+        # rebound data first, so that queries running meanwhile never see ids past their data
+        self.data = np.vstack([self.data, data])
+        self.lists = [np.concatenate([ids, new_ids]) if len(new_ids) else ids
+                      for ids, new_ids in zip(self.lists, added)]
+
+    def needs_rebuild(self):
+        return len(self.data) > (1.0 + self.rebuild_ratio) * self.base_size
+
+    def split_lists(self, assignment, first_id):
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.searchsorted(assignment[order], np.arange(len(self.centroids) + 1))
+        return [first_id + order[offsets[cell]: offsets[cell + 1]] for cell in range(len(self.centroids))]
+
+    def train_centroids(self, n_lists):
+        # k-means on a bounded random sample, so that fitting does not scale with the whole collection
+        random = np.random.RandomState(self.seed)
+        sample_size = min(len(self.data), n_lists * self.sample_size)
+        sample = self.data[random.choice(len(self.data), sample_size, replace=False)]
+        centroids = sample[random.choice(sample_size, n_lists, replace=False)]
+        for _ in range(self.n_iter):
+            assignment = np.argmin(squared_distances(sample, centroids), axis=1)
+            counts = np.bincount(assignment, minlength=n_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = counts == 0
+            centroids = np.where(empty[:, None], centroids, sums / np.maximum(counts, 1)[:, None])
+            # re-seed empty cells with random samples
+            if np.any(empty):
+                centroids[empty] = sample[random.choice(sample_size, np.count_nonzero(empty))]
+        return centroids
+
+    def assign(self, data, chunk_size=4096):
+        return np.concatenate([np.argmin(squared_distances(data[i: i + chunk_size], self.centroids), axis=1)
+                               for i in range(0, len(data), chunk_size)])
+
+    def candidates(self, lists, order):
+        probed, count = [], 0
+        # keep probing beyond n_probe if the cells are too small to hold enough neighbors
+        for cell in order:
+            if len(probed) >= self.n_probe and count >= self.neighbors:
+                break
+            probed.append(lists[cell])
+            count += len(probed[-1])
+        return np.concatenate(probed)
+
+    def query(self, queries):
+        queries = np.asarray(queries, dtype=np.float64)
+        # lists before data, add rebinds them in the opposite order
+        lists, data = self.lists, self.data
+        # as many neighbors as there are rows, if there are fewer than self.neighbors
+        neighbors = min(self.neighbors, len(data))
+        result = np.empty((len(queries), neighbors), dtype=np.intp)
+        cell_orders = np.argsort(squared_distances(queries, self.centroids), axis=1)
+        for row, (query, order) in enumerate(zip(queries, cell_orders)):
+            ids = self.candidates(lists, order)
+            distances = squared_distances(query[None, :], data[ids])[0]
+            nearest = np.argpartition(distances, neighbors - 1)[:neighbors] \
+                if len(ids) > neighbors else np.arange(len(ids))
+            result[row] = ids[nearest[np.argsort(distances[nearest], kind="stable")]]
+        return result
+
+
+backends = {"exact": ExactIndex, "ivf": IVFIndex}
+
+
+def benchmark_backends(data, queries, weight, neighbors=3, n_probes=(1, 2, 4, 8, 16, 32)):
+    """
+    Compare the recall and latency of the ivf backend with those of the exact backend.
+    The ground truth sorts all the squared euclidean distances between the queries and the data, both scaled by
+    the square root of the landmark weights, which orders the rows as the metric of Comparator.construct_metric does.
+    core.regression checks Comparator against that metric itself.
+    """
+    from .comparator import Comparator
+
+    landmark_weight = Comparator.construct_weight(weight)
+    data, queries = np.asarray(data, dtype=np.float64), np.asarray(queries, dtype=np.float64)
+    truth = np.argsort(squared_distances(queries * np.sqrt(landmark_weight), data * np.sqrt(landmark_weight)),
+                       axis=1, kind="stable")[:, :neighbors]
+
+    def measure(comparator):
+        start = time.time()
+        matches = comparator.batch(queries)
+        elapsed = (time.time() - start) / len(queries)
+        recall = np.mean([len(np.intersect1d(match, expected)) / neighbors
+                          for match, expected in zip(matches, truth)])
+        return recall, elapsed
+
+    results = []
+    start = time.time()
+    exact = Comparator(data, neighbors, weight, backend="exact")
+    print(f"exact: build {time.time() - start:.3f}s")
+    recall, elapsed = measure(exact)
+    print(f"exact: recall {recall * 100.0:.2f}%, {elapsed * 1e3:.3f}ms/query")
+    results.append(("exact", recall, elapsed))
+
+    start = time.time()
+    approximate = Comparator(data, neighbors, weight, backend="ivf")
+    print(f"ivf: build {time.time() - start:.3f}s, {len(approximate.index.centroids)} lists")
+    for n_probe in n_probes:
+        approximate.index.n_probe = n_probe
+        recall, elapsed = measure(approximate)
+        print(f"ivf (n_probe={n_probe}): recall {recall * 100.0:.2f}%, {elapsed * 1e3:.3f}ms/query")
+        results.append((f"ivf-{n_probe}", recall, elapsed))
+    return results
+
+
+if __name__ == "__main__":
+    from database import PaintingDatabaseHandler
+    from .comparator import Comparator
+
+    landmarks = PaintingDatabaseHandler().load_landmarks()[3]
+    np.random.shuffle(landmarks)
+    benchmark_backends(landmarks[100:], landmarks[:100], Comparator.default_weight)
@@ -1,7 +1,8 @@
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Manager, Process
-from threading import Thread
+from threading import BoundedSemaphore, Thread
 
-__all__ = ["ProcessPool", "ThreadPool"]
+__all__ = ["ProcessPool", "ThreadPool", "WorkerPool", "QueueFullError"]
 
 
 class _Pool(object):
@@ -49,3 +50,33 @@ class ThreadPool(_Pool):
 
     def __init__(self, num_thread, func, args, shared):
         super().__init__(Thread, num_thread, func, args, shared)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class WorkerPool(object):
+    """
+    Run tasks on a fixed number of threads, with at most max_queue tasks waiting for a thread.
+    submit raises QueueFullError instead of queueing more, so that callers can reject the work.
+    """
+
+    def __init__(self, num_worker, max_queue):
+        self.executor = ThreadPoolExecutor(max_workers=num_worker)
+        self.slots = BoundedSemaphore(num_worker + max_queue)
+
+    def submit(self, func, *args, **kwargs):
+        if not self.slots.acquire(blocking=False):
+            raise QueueFullError()
+        try:
+            future = self.executor.submit(func, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def shutdown(self):
+        # waits for the running and queued tasks to finish
+        self.executor.shutdown(wait=True)
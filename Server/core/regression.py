@@ -0,0 +1,76 @@
+"""
+Checks of the vectorized landmark code against the implementations it replaced, kept here as references.
+
+check_comparator: Comparator, which searches pre-scaled landmarks with a euclidean index, against the
+sklearn search with the weighted metric of Comparator.construct_metric.
+
+check_detector: LandmarksDetector.normalize_landmarks_batch and pose_landmarks_batch against the
+per-face, per-region loops they replaced, on faces jittered around the model face.
+
+python -m core.regression
+"""
+
+import numpy as np
+from sklearn.neighbors import NearestNeighbors
+
+from .comparator import Comparator
+from .detector import LandmarksDetector
+
+
+def reference_matches(data, queries, neighbors, weight=Comparator.default_weight):
+    searcher = NearestNeighbors(metric=Comparator.construct_metric(weight), n_neighbors=neighbors).fit(data)
+    return searcher.kneighbors(queries, return_distance=False)
+
+
+def check_comparator(data, queries, neighbors=3, weight=Comparator.default_weight):
+    expected = reference_matches(data, queries, neighbors, weight)
+    matches = Comparator(data, neighbors, weight).batch(queries)
+    assert np.array_equal(matches, expected), "Comparator neighbors differ from the weighted metric search"
+
+    # appended rows are searched from the delta buffer before the comparator is rebuilt
+    comparator = Comparator(data[:len(data) // 2], neighbors, weight)
+    comparator.append(data[len(data) // 2:])
+    assert np.array_equal(comparator.batch(queries), expected), "Neighbors differ after append"
+    assert np.array_equal(comparator.rebuild().batch(queries), expected), "Neighbors differ after rebuild"
+    print(f"Comparator: {len(queries)} queries over {len(data)} rows match the weighted metric search")
+
+
+def reference_normalize(landmarks):
+    landmarks = np.array(landmarks, dtype=np.float64).transpose()
+    for _, (start, end), (left, right) in LandmarksDetector.landmark_map:
+        leftmost, rightmost = left - start, right - start
+        points = landmarks[:, start: end]
+        points -= np.array([points[0][leftmost], np.mean(points[1, :])]).reshape(2, 1)
+        points *= 2.0 / points[0][rightmost]
+        points[0, :] -= 1.0
+    return np.hstack([landmarks[0, :], landmarks[1, :]])
+
+
+def reference_pose(landmarks):
+    source_points = landmarks[LandmarksDetector.transform_base].transpose()
+    source_matrix = np.vstack([source_points, np.ones([1, 3])])
+    rotation_matrix = np.dot(LandmarksDetector.target_matrix, np.linalg.inv(source_matrix))[0:2, 0:2]
+    return reference_normalize(np.dot(rotation_matrix, landmarks.transpose()).transpose())
+
+
+def random_faces(count, random):
+    # the model face rotated, scaled and moved, with a few pixels of noise on each point
+    angles = random.uniform(-0.5, 0.5, count)
+    rotations = np.stack([np.cos(angles), -np.sin(angles), np.sin(angles), np.cos(angles)], axis=1).reshape(-1, 2, 2)
+    faces = np.matmul(LandmarksDetector.face_raw_model * random.uniform(100, 400, (count, 1, 1)),
+                      rotations.transpose(0, 2, 1))
+    return faces + random.uniform(0, 500, (count, 1, 2)) + random.randn(count, 68, 2)
+
+
+def check_detector(faces, tolerance=1e-9):
+    normalized = LandmarksDetector.normalize_landmarks_batch(faces)
+    posed = LandmarksDetector.pose_landmarks_batch(faces)
+    np.testing.assert_allclose(normalized, [reference_normalize(face) for face in faces], rtol=0, atol=tolerance)
+    np.testing.assert_allclose(posed, [reference_pose(face) for face in faces], rtol=0, atol=tolerance)
+    print(f"LandmarksDetector: {len(faces)} faces normalized and posed within {tolerance} of the per-face loops")
+
+
+if __name__ == "__main__":
+    random = np.random.RandomState(0)
+    check_comparator(random.randn(2000, 136), random.randn(50, 136))
+    check_detector(random_faces(500, random))
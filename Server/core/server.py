@@ -1,11 +1,17 @@
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from collections import Counter
+from functools import partial
+from socketserver import ThreadingMixIn
+from threading import Condition, Lock, Thread
 import time
 from io import BytesIO
 import json
 import socket
 import os
-import subprocess
+import shutil
+import signal
 import glob
+import traceback
 
 import requests
 import numpy as np
@@ -13,11 +19,16 @@ from PIL import Image
 from zeroconf import ServiceInfo, Zeroconf
 from sklearn.externals import joblib
 
-from .comparator import Comparator
-from .detector import LandmarksDetector
+from .cache import ByteCache, StylizedCache
+from .derivative import find_derivative
+from .gallery import PaintingGallery
+from .pool import WorkerPool, QueueFullError
+from .detector import FaceDetector, LandmarksDetector
+from .tracking import TrackingSessions
 from database import PaintingDatabaseHandler,\
-    emotions, style_path, svm_path, faces_dir, temp_dir
-from transfer import StyleTransfer
+    style_path, preview_path, svm_path, faces_dir, derivative_dir, temp_dir
+from transfer import StyleTransfer, TransferScheduler
+from transfer.export import FrozenStyleTransfer
 
 host_name = ""  # if use "localhost", this server will only be accessible for the local machine
 host_port = 8080
@@ -26,22 +37,66 @@ id_string = "PEAServer"
 app_id = "OH4VbcK1AXEtklkhpkGCikPB-MdYXbMMI"
 app_key = "0azk0HxCkcrtNGIKC5BMwxnr"
 cloud_url = "https://us-api.leancloud.cn/1.1/classes/Server/5a40a4eee37d040044aa4733"
-valid_operations = {"Store", "Delete", "Retrieve", "Transfer"}
-
-db_handler = PaintingDatabaseHandler()
+valid_operations = {"Store", "Delete", "Retrieve", "BatchRetrieve", "Track", "Transfer", "Refresh"}
+required_headers = {"Store": "Photo-Timestamp", "BatchRetrieve": "Face-Lengths", "Track": "Session-Id",
+                    "Transfer": "Photo-Timestamp"}  # POST requests without them are rejected with 400
+index_backend = "exact"  # use "ivf" for approximate search on large painting collections
+index_options = {}  # e.g. {"n_probe": 8} for the "ivf" backend, the mapped "exact" backend defaults to "brute"
+map_gallery = True  # start from the file exported by "python -m core.gallery" if it is up to date
+verify_gallery = False  # checksum the mapped gallery file when loading it, which reads all of it
+refresh_interval = 0  # seconds between polls for new paintings in the database, 0 to disable
+cache_budget = 256 * 1024 * 1024  # bytes of encoded paintings and portraits kept in memory
+concurrent = True  # serve each request on its own thread, otherwise one request at a time
+num_workers = os.cpu_count()  # threads running landmark detection and style transfer
+max_queue = 2 * num_workers  # requests waiting for a worker before new ones are rejected with 429
+drain_timeout = 60  # seconds to wait for in-flight requests when shutting down
+transfer_max_batch = 4  # style transfer requests run through the network together
+transfer_max_wait = 0.05  # seconds to wait for more requests to fill a style transfer batch
+stylized_budget = 64 * 1024 * 1024  # bytes of stylized photos kept in memory, all of them are also kept on disk
+store_limit = 2000  # length of the longer side of stored photos
+tile_size = 512  # photos larger than this are stylized tile by tile, to bound the memory of the network
+tile_overlap = 32  # pixels shared by neighboring tiles, over which they are blended
+speculative_styles = 3  # most requested styles transferred in the background after Store, 0 to disable
+export_dir = None  # directory written by "python -m transfer.export" to run instead of the Keras model
+preview_size = 256  # length of the longer side of photos stylized for a Transfer with the "Preview: true" header
+preview_model = True  # stylize previews with the narrower model at preview_path, if it exists
+intra_op_threads = 0  # threads running one operation of the style transfer network, 0 for one per core
+inter_op_threads = 0  # operations of the network run in parallel, 0 for one per core
+cpu_affinity = None  # cores this process is bound to, e.g. range(0, 4), None to leave it to the scheduler, Linux only
+track_confidence = 8  # correlation tracker confidence below which the face of a Track session is detected again
+track_overlap = 0.8  # matches are reused while the face box overlaps the matched one at least this much
+track_max_reuse = 15  # frames after which matches are computed again, even if the face did not move
+session_timeout = 60  # seconds after which an idle Track session is dropped
+
+if cpu_affinity is not None:
+    if hasattr(os, "sched_setaffinity"):
+        # set before the models are loaded, so that the thread pools they create inherit it
+        os.sched_setaffinity(0, cpu_affinity)
+    else:
+        print(f"{time.asctime()} cpu_affinity ignored, processes cannot be bound to cores on this platform")
+db_handler = PaintingDatabaseHandler()  # each thread uses its own pooled connection
 detector = LandmarksDetector()
+face_detector = FaceDetector()
+tracking_sessions = TrackingSessions(session_timeout)
 svm = joblib.load(svm_path)
-paintings = db_handler.get_all_landmarks()
-painting_landmarks = [[] for _ in range(len(emotions))]
-painting_map = [[] for _ in range(len(emotions))]
-for lid, pid, eid, _, points, _ in paintings:
-    painting_map[eid].append([lid, pid])
-    painting_landmarks[eid].append(points)
-painting_comparators = [Comparator(points, 3) for points in painting_landmarks]
-style_transfer = StyleTransfer(style_path)
-painting_faces = []
-for img_file in sorted(glob.glob(os.path.join(faces_dir, "*.jpg"))):
-    painting_faces.append(Image.open(img_file))
+gallery = PaintingGallery(3, index_backend, index_options)
+if map_gallery:
+    gallery.load(verify=verify_gallery)
+gallery.refresh()  # loads the whole table if the file was not mapped, otherwise only rows added since export
+threads = {"intra_op_threads": intra_op_threads, "inter_op_threads": inter_op_threads}
+style_transfer = FrozenStyleTransfer(export_dir, **threads) if export_dir else StyleTransfer(style_path, **threads)
+transfer_scheduler = TransferScheduler(style_transfer, transfer_max_batch, transfer_max_wait)
+if preview_model and os.path.isfile(preview_path):
+    preview_scheduler = TransferScheduler(StyleTransfer(preview_path, **threads), transfer_max_batch, transfer_max_wait)
+else:
+    preview_scheduler = transfer_scheduler
+stylized_cache = StylizedCache(os.path.join(temp_dir, "stylized"), stylized_budget)
+style_counts = Counter()  # style index -> number of times it was requested
+style_counts_lock = Lock()
+# face ids start from 1, face files are only opened on their first retrieval
+face_files = sorted(glob.glob(os.path.join(faces_dir, "*.jpg")))
+image_cache = ByteCache(cache_budget)
+workers = WorkerPool(num_workers, max_queue)
 
 
 def print_with_date(content):
@@ -63,6 +118,373 @@ def publish_address(address):
         print_with_date(f"Failed in publishing server address: {response.reason}")
 
 
+def get_photo_path(timestamp):
+    return os.path.join(temp_dir, f"{timestamp}.jpg")
+
+
+def get_painting_filename(painting_id):
+    # the connection goes back to the pool, request threads come and go
+    try:
+        return db_handler.get_painting_filename(painting_id)
+    finally:
+        db_handler.release()
+
+
+def encode_jpeg(path):
+    image_bytes = BytesIO()
+    Image.open(path).save(image_bytes, format="jpeg")
+    return image_bytes.getvalue()
+
+
+def find_derivatives(painting_id, face_id, max_dimension):
+    # derivatives are named after the painting / face file they were rendered from
+    face_name = os.path.splitext(os.path.basename(face_files[face_id - 1]))[0]
+    return (find_derivative(os.path.join(derivative_dir, "paintings"), str(painting_id), max_dimension),
+            find_derivative(os.path.join(derivative_dir, "faces"), face_name, max_dimension))
+
+
+def part_length(part):
+    # a part is either encoded bytes or the path of a pre-rendered file
+    return os.path.getsize(part) if isinstance(part, str) else len(part)
+
+
+def match_faces(face_images):
+    # returns the (face id, painting id) of the paintings matching each face
+    landmarks = np.array([detector(np.array(face_image), 0, 0, face_image.size[1], face_image.size[0])
+                          for face_image in face_images]).reshape(-1, 68, 2)
+    normalized = detector.normalize_landmarks_batch(landmarks)
+    posed = detector.pose_landmarks_batch(landmarks)
+    return gallery.match(normalized, svm.predict(posed))
+
+
+def load_match(face_id, painting_id, max_dimension=None):
+    original, face = find_derivatives(painting_id, face_id, max_dimension) if max_dimension else (None, None)
+    if original is None:
+        original = image_cache.get(("painting", painting_id),
+                                   lambda: encode_jpeg(get_painting_filename(painting_id)))
+    if face is None:
+        face = image_cache.get(("face", face_id), lambda: encode_jpeg(face_files[face_id - 1]))
+    return original, face
+
+
+def retrieve_paintings(face_images, max_dimension=None):
+    return load_matches(match_faces(face_images), max_dimension)
+
+
+def load_matches(face_matches, max_dimension=None):
+    image_info, image_parts = [], []
+    for matches in face_matches:
+        face_info = []
+        for face_id, painting_id in matches:
+            original, face = load_match(face_id, painting_id, max_dimension)
+            image_parts += [original, face]
+            face_info.append({
+                "Painting-Id": painting_id,
+                "Painting-Length": part_length(original),
+                "Portrait-Length": part_length(face),
+            })
+        image_info.append(face_info)
+    print_with_date(f"Image cache {image_cache.stats()}")
+    print_with_date(f"Database pool {db_handler.pool.stats()}")
+    return image_info, image_parts
+
+
+def track_face(session_id, frame_image, max_dimension=None):
+    """
+    Returns the face box in the frame, or None if there is no face, with the Image-Info and parts
+    of its matches, or None if the matches of the previous frame still hold.
+    """
+    session = tracking_sessions.get(session_id)
+    frame = np.array(frame_image.convert("RGB"))
+    with session.lock:
+        bbox = session.locate(frame, face_detector, track_confidence)
+        if bbox is None or session.reuse(track_overlap, track_max_reuse):
+            return bbox, None
+        landmarks = detector(frame, *bbox).reshape(1, 68, 2)
+        face_matches = gallery.match(detector.normalize_landmarks_batch(landmarks),
+                                     svm.predict(detector.pose_landmarks_batch(landmarks)))
+        session.matched()
+    return bbox, load_matches(face_matches, max_dimension)
+
+
+def store_photo(photo_file, timestamp):
+    photo = open_image(photo_file)
+
+    # currently set a limit to the length of the longer side of the photo
+    limit = store_limit
+    if photo.size[0] > limit or photo.size[1] > limit:
+        ratio = max(photo.size[0], photo.size[1]) / limit
+        photo = photo.resize((int(photo.size[0] / ratio), int(photo.size[1] / ratio)), Image.ANTIALIAS)
+
+    photo.save(get_photo_path(timestamp))
+
+
+def speculate(photo_path):
+    # transfer the most requested styles of a new photo in the background, so that they are cached
+    with style_counts_lock:
+        style_indices = [style_index for style_index, _ in style_counts.most_common(speculative_styles)]
+    content_hash, size = StylizedCache.content_hash(photo_path), Image.open(photo_path).size
+    keys = [StylizedCache.key(content_hash, style_index, size) for style_index in style_indices]
+    missing = [(style_index, key) for style_index, key in zip(style_indices, keys) if key not in stylized_cache]
+    if not missing:
+        return
+
+    if max(size) > tile_size:
+        # tiled photos are left to the foreground, their tiles would hold the network for too long
+        return
+    img = style_transfer.load_image(photo_path)
+    for style_index, key in missing:
+        future = transfer_scheduler.submit(img, [style_index], background=True, tag=photo_path)
+        future.add_done_callback(partial(store_speculated, photo_path, key))
+    print_with_date(f"Speculate styles {[style_index for style_index, _ in missing]} for {photo_path}")
+
+
+def store_speculated(photo_path, key, future):
+    # the photo may have been deleted while it was being transferred
+    if future.cancelled() or future.exception() is not None or not os.path.isfile(photo_path):
+        return
+    stylized_cache.put(key, encode_stylized(future.result()[0]))
+
+
+def start_speculation(timestamp):
+    # speculation is skipped when the workers are busy with requests
+    if speculative_styles:
+        try:
+            workers.submit(speculate, get_photo_path(timestamp))
+        except QueueFullError:
+            pass
+
+
+def delete_photo(timestamp):
+    file_path = get_photo_path(timestamp)
+    cancelled = transfer_scheduler.cancel(file_path)
+    if cancelled:
+        print_with_date(f"{cancelled} speculative transfers cancelled")
+    if os.path.isfile(file_path):
+        stylized_cache.invalidate(StylizedCache.content_hash(file_path))
+        os.remove(file_path)
+        print_with_date(f"{file_path} removed")
+    else:
+        print_with_date(f"{file_path} not exists")
+
+
+def encode_stylized(stylized):
+    image_bytes = BytesIO()
+    Image.fromarray(stylized).save(image_bytes, format="jpeg")
+    return image_bytes.getvalue()
+
+
+def transfer_photo(photo_path, style_index, preview=False):
+    return transfer_photo_indices(photo_path, [style_index], preview)[0]
+
+
+def transfer_photo_indices(photo_path, style_indices, preview=False):
+    content_hash, size = StylizedCache.content_hash(photo_path), Image.open(photo_path).size
+    if preview:
+        # a preview is followed by a full request of the same styles, which is the one counted
+        scheduler, max_dimension = preview_scheduler, preview_size
+        scale = min(1.0, preview_size / max(size))
+        size = (round(size[0] * scale), round(size[1] * scale))
+    else:
+        scheduler, max_dimension = transfer_scheduler, None
+        with style_counts_lock:
+            style_counts.update(style_indices)
+
+    # only the styles missing from the cache go through the network
+    keys = [StylizedCache.key(content_hash, style_index, size, preview) for style_index in style_indices]
+    stylized = [stylized_cache.get(key) for key in keys]
+    missing = [i for i, image_bytes in enumerate(stylized) if image_bytes is None]
+    print_with_date(f"{len(style_indices) - len(missing)} of {len(style_indices)} styles cached")
+
+    transferred = scheduler.transfer_styles(photo_path, [style_indices[i] for i in missing],
+                                            tile_size, tile_overlap, max_dimension) if missing else []
+    for i, img in zip(missing, transferred):
+        stylized[i] = encode_stylized(img)
+        stylized_cache.put(keys[i], stylized[i])
+    return stylized
+
+
+def transfer_photo_styles(photo_path, style_ids, preview=False):
+    # returns the Image-Info of the stylized photos, and their bytes in the same order
+    # style_id should subtract 1 before used as index, since the database starts indexing from 1
+    stylized = transfer_photo_indices(photo_path, [style_id - 1 for style_id in style_ids], preview)
+    return [{"Style-Id": style_id, "Length": len(image_bytes)}
+            for style_id, image_bytes in zip(style_ids, stylized)], stylized
+
+
+class Reply(object):
+    # the status, headers and body of a response, written out by either front end
+    def __init__(self, code, content_type="application/json", extra_info=None, parts=()):
+        self.code = code
+        self.content_type = content_type
+        self.extra_info = extra_info or {}
+        self.parts = parts  # encoded bytes or paths of pre-rendered files, sent one after the other
+
+
+def error_reply(err):
+    # the reply to a request whose handling raised err
+    if isinstance(err, QueueFullError):
+        print_with_date("Too many requests in queue")
+        return Reply(429, extra_info={"Retry-After": "1"})
+    if isinstance(err, (ValueError, KeyError)):
+        print_with_date(f"Invalid request: {err!r}")
+        return Reply(400)
+    print_with_date(f"Request failed: {err!r}")
+    traceback.print_exception(type(err), err, err.__traceback__)
+    return Reply(500)
+
+
+def open_image(image_file):
+    # undecodable images are invalid requests rather than server errors
+    try:
+        image = Image.open(image_file)
+        image.load()
+    except OSError as err:
+        raise ValueError(f"Cannot decode image: {err}")
+    return image
+
+
+def read_faces(headers, body):
+    # the body of a BatchRetrieve is the concatenation of several face crops, whose lengths are listed in Face-Lengths
+    if headers["Operation"] == "Retrieve":
+        return [open_image(body)]
+    content, face_images, offset = body.read(), [], 0
+    for face_length in json.loads(headers["Face-Lengths"]):
+        face_images.append(open_image(BytesIO(content[offset: offset + face_length])))
+        offset += face_length
+    print_with_date(f"Retrieve paintings for {len(face_images)} faces")
+    return face_images
+
+
+def max_dimension_of(headers):
+    return int(headers["Max-Dimension"]) if "Max-Dimension" in headers else None
+
+
+def check_post(headers):
+    # the status a POST request is rejected with before its body is read, None if its headers are valid
+    if headers.get("Authentication") != auth_string:
+        print_with_date("Not authenticated")
+        return 401
+    if headers.get("Operation") not in valid_operations:
+        print_with_date("No operation / Invalid operation")
+        return 400
+    required = required_headers.get(headers["Operation"])
+    if required is not None and required not in headers:
+        print_with_date(f"No {required} provided")
+        return 400
+    return None
+
+
+def handle_post(headers, body):
+    """
+    Run the operation of a POST request that passed check_post, with its body as a file object, and return
+    its Reply. Runs on a worker of the pool. Raises ValueError or KeyError if the body or a header is malformed.
+    """
+    operation = headers["Operation"]
+    if operation == "Store":
+        store_photo(body, headers["Photo-Timestamp"])
+        start_speculation(headers["Photo-Timestamp"])
+        return Reply(200)
+
+    elif operation in ("Retrieve", "BatchRetrieve"):
+        image_info, image_parts = retrieve_paintings(read_faces(headers, body), max_dimension_of(headers))
+        # Image-Info holds one list per face of a BatchRetrieve, in the same order as the faces in the request
+        return Reply(200, "application/octet-stream",
+                     {"Image-Info": json.dumps(image_info[0] if operation == "Retrieve" else image_info)},
+                     image_parts)
+
+    elif operation == "Track":
+        # successive frames of a camera, responds 304 if the matches of the previous frame still hold
+        bbox, retrieved = track_face(headers["Session-Id"], open_image(body), max_dimension_of(headers))
+        if bbox is None:
+            return Reply(204)
+        elif retrieved is None:
+            return Reply(304, extra_info={"Face-Box": json.dumps(bbox)})
+        image_info, image_parts = retrieved
+        return Reply(200, "application/octet-stream",
+                     {"Image-Info": json.dumps(image_info[0]), "Face-Box": json.dumps(bbox)}, image_parts)
+
+    elif operation == "Transfer":
+        photo_path = get_photo_path(headers["Photo-Timestamp"])
+        # a quick low resolution result, the client requests the full one afterwards
+        preview = headers.get("Preview", "").lower() == "true"
+        if not os.path.isfile(photo_path):
+            print_with_date(f"{photo_path} not exists")
+            return Reply(404)
+        elif "Style-Ids" in headers:
+            # several styles in one request, the stylized photos are concatenated in the body
+            style_ids = json.loads(headers["Style-Ids"])
+            print_with_date(f"Start transfer styles {style_ids}")
+            image_info, image_parts = transfer_photo_styles(photo_path, style_ids, preview)
+            return Reply(200, "application/octet-stream", {"Image-Info": json.dumps(image_info)}, image_parts)
+        style_id = int(headers["Style-Id"])
+        print_with_date(f"Start transfer style {style_id}")
+        # style_id should subtract 1 before used as index, since the database starts indexing from 1
+        return Reply(200, "application/octet-stream", parts=[transfer_photo(photo_path, style_id - 1, preview)])
+
+    elif operation == "Refresh":
+        added = gallery.refresh()
+        print_with_date(f"{added} new paintings added to gallery")
+        return Reply(200, parts=[json.dumps({"Added": added, "Total": len(gallery)}).encode()])
+
+    print_with_date("Shouldn't reach here")
+    return Reply(404)
+
+
+def handle_delete(headers):
+    # returns the status of a DELETE request
+    if headers.get("Authentication") != auth_string:
+        print_with_date("Not authenticated")
+        return 401
+    elif "Session-Id" in headers:
+        # the client stopped sending frames
+        return 200 if tracking_sessions.close(headers["Session-Id"]) else 404
+    elif "Photo-Timestamp" not in headers:
+        print_with_date("No timestamp provided")
+        return 400
+    delete_photo(headers["Photo-Timestamp"])
+    return 200
+
+
+class PEAServer(ThreadingMixIn, HTTPServer):
+    """
+    Handle each request on its own thread, and keep count of the requests in flight,
+    so that shutting down can wait for them to finish.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class):
+        super().__init__(server_address, handler_class)
+        self.active = 0
+        self.idle = Condition()
+
+    def process_request(self, request, client_address):
+        # counted before the thread starts, so that drain never misses an accepted request
+        with self.idle:
+            self.active += 1
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self.finish_request_count()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.finish_request_count()
+
+    def finish_request_count(self):
+        with self.idle:
+            self.active -= 1
+            self.idle.notify_all()
+
+    def drain(self, timeout):
+        with self.idle:
+            return self.idle.wait_for(lambda: not self.active, timeout)
+
+
 class MyServer(BaseHTTPRequestHandler):
 
     def _set_headers(self, code, content_type="application/json", extra_info=None):
@@ -72,81 +494,34 @@ class MyServer(BaseHTTPRequestHandler):
             [self.send_header(key, value) for key, value in extra_info.items()]
         self.end_headers()
 
+    def _write_parts(self, parts):
+        for part in parts:
+            if isinstance(part, str):
+                # pre-rendered files go from the page cache to the socket without being copied or decoded
+                self.wfile.flush()
+                with open(part, "rb") as f:
+                    self.connection.sendfile(f)
+            else:
+                self.wfile.write(part)
+
+    def _respond(self, reply):
+        self._set_headers(reply.code, reply.content_type, reply.extra_info)
+        self._write_parts(reply.parts)
+
     def do_POST(self):
         start_time = time.time()
         print_with_date("Receive a POST request")
 
-        if "Authentication" not in self.headers or self.headers["Authentication"] != auth_string:
-            print_with_date("Not authenticated")
-            self._set_headers(401)
-
-        elif "Operation" not in self.headers or self.headers["Operation"] not in valid_operations:
-            print_with_date("No operation / Invalid operation")
-            self._set_headers(400)
-
-        elif self.headers["Operation"] == "Store":
-            if "Photo-Timestamp" not in self.headers:
-                print_with_date("No timestamp provided")
-                self._set_headers(400)
-
-            else:
-                content_length = int(self.headers["Content-Length"])
-                photo = Image.open(BytesIO(self.rfile.read(content_length)))
-
-                # currently set a limit to the length of the longer side of the photo
-                limit = 500
-                if photo.size[0] > limit or photo.size[1] > limit:
-                    ratio = max(photo.size[0], photo.size[1]) / limit
-                    photo = photo.resize((int(photo.size[0] / ratio), int(photo.size[1] / ratio)), Image.ANTIALIAS)
-
-                photo.save(f"{temp_dir}{self.headers['Photo-Timestamp']}.jpg")
-                self._set_headers(200)
-
-        elif self.headers["Operation"] == "Retrieve":
-            content_length = int(self.headers["Content-Length"])
-            face_image = Image.open(BytesIO(self.rfile.read(content_length)))
-
-            landmarks = detector(np.array(face_image), 0, 0, face_image.size[1], face_image.size[0])
-            normalized = detector.normalize_landmarks(landmarks)
-            posed = detector.pose_landmarks(landmarks)
-
-            image_info, image_bytes = [], BytesIO()
-            emotion_id = svm.predict([posed])[0]
-            for idx in painting_comparators[emotion_id](normalized):
-                face_id, painting_id = painting_map[emotion_id][idx]
-                face = painting_faces[face_id - 1]
-                prev_len = len(image_bytes.getvalue())
-                original = Image.open(db_handler.get_painting_filename(painting_id))
-                original.save(image_bytes, format="jpeg")
-                mid_len = len(image_bytes.getvalue())
-                face.save(image_bytes, format="jpeg")
-                image_info.append({
-                    "Painting-Id": painting_id,
-                    "Painting-Length": mid_len - prev_len,
-                    "Portrait-Length": len(image_bytes.getvalue()) - mid_len,
-                })
-
-            self._set_headers(200, "application/octet-stream", {"Image-Info": json.dumps(image_info)})
-            self.wfile.write(image_bytes.getvalue())
-
-        elif self.headers["Operation"] == "Transfer":
-            os.chdir(temp_dir)
-            photo_path = f"{self.headers['Photo-Timestamp']}.jpg"
-            if os.path.isfile(photo_path):
-                style_id = int(self.headers["Style-Id"])
-                print_with_date(f"Start transfer style {style_id}")
-
-                # style_id should subtract 1 before used as index, since the database starts indexing from 1
-                stylized = Image.fromarray(style_transfer(photo_path, temp_dir, style_id - 1))
-                image_bytes = BytesIO()
-                stylized.save(image_bytes, format="jpeg")
-
-                self._set_headers(200, "application/octet-stream")
-                self.wfile.write(image_bytes.getvalue())
-
+        code = check_post(self.headers)
+        if code is not None:
+            self._respond(Reply(code))
         else:
-            print_with_date("Shouldn't reach here")
-            self._set_headers(404)
+            try:
+                body = BytesIO(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                reply = workers.submit(handle_post, self.headers, body).result()
+            except Exception as err:
+                reply = error_reply(err)
+            self._respond(reply)
 
         print_with_date("Response sent")
         print_with_date(f"Elapsed time {time.time() - start_time:.3f}s")
@@ -154,32 +529,14 @@ class MyServer(BaseHTTPRequestHandler):
     def do_DELETE(self):
         start_time = time.time()
         print_with_date("Receive a DELETE request")
-
-        if "Authentication" not in self.headers or self.headers["Authentication"] != auth_string:
-            print_with_date("Not authenticated")
-            self._set_headers(401)
-
-        elif "Photo-Timestamp" not in self.headers:
-            print_with_date("No timestamp provided")
-            self._set_headers(400)
-
-        else:
-            file_path = f"{temp_dir}{self.headers['Photo-Timestamp']}.jpg"
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-                print_with_date(f"{file_path} removed")
-            else:
-                print_with_date(f"{file_path} not exists")
-            self._set_headers(200)
-
+        self._respond(Reply(handle_delete(self.headers)))
         print_with_date("Response sent")
         print_with_date(f"Elapsed time {time.time() - start_time:.3f}s")
 
 
-if __name__ == "__main__":
-    server = HTTPServer((host_name, host_port), MyServer)
+def start_services(port):
     ip = get_ip_address()
-    server_address = f"http://{ip}:{host_port}"
+    server_address = f"http://{ip}:{port}"
     publish_address(server_address)
     print_with_date("Server started - " + server_address)
 
@@ -191,17 +548,53 @@ if __name__ == "__main__":
     zeroconf.register_service(info)
     print_with_date(f"Multi-cast service registered - {txtRecord}")
 
+    if refresh_interval:
+        gallery.start_polling(refresh_interval)
+    return zeroconf, info
+
+
+def clear_temp_dir():
+    # stored photos and the stylized cache, nothing outside temp_dir is touched even if it is missing
+    if not os.path.isdir(temp_dir):
+        return
+    for entry in os.scandir(temp_dir):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.remove(entry.path)
+
+
+def stop_services(zeroconf, info):
+    gallery.stop_polling()
+    workers.shutdown()
+    transfer_scheduler.shutdown()
+    if preview_scheduler is not transfer_scheduler:
+        preview_scheduler.shutdown()
+
+    clear_temp_dir()
+    print_with_date("Temp folder cleared")
+
+    zeroconf.unregister_service(info)
+    zeroconf.close()
+    print_with_date(f"Multi-cast service unregistered - {info.properties}")
+
+
+if __name__ == "__main__":
+    server = (PEAServer if concurrent else HTTPServer)((host_name, host_port), MyServer)
+    zeroconf, info = start_services(host_port)
+
+    # shutdown blocks until serve_forever returns, so it cannot be called on the serving thread
+    signal.signal(signal.SIGTERM, lambda *_: Thread(target=server.shutdown).start())
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         print_with_date("Keyboard interrupt")
 
+    if concurrent:
+        print_with_date("Waiting for requests in flight")
+        if not server.drain(drain_timeout):
+            print_with_date(f"Requests still in flight after {drain_timeout}s")
     server.server_close()
-    print_with_date("Server stopped - " + server_address)
-
-    subprocess.call([f"cd {temp_dir}; rm *"], shell=True)
-    print_with_date("Temp folder cleared")
+    print_with_date("Server stopped")
 
-    zeroconf.unregister_service(info)
-    zeroconf.close()
-    print_with_date(f"Multi-cast service unregistered - {txtRecord}")
+    stop_services(zeroconf, info)
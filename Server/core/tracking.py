@@ -0,0 +1,92 @@
+from threading import Lock
+import time
+
+from dlib import correlation_tracker
+
+from .detector import Rectangle
+
+__all__ = ["TrackingSession", "TrackingSessions"]
+
+
+def overlap(bbox, other):
+    # intersection over union of two [left, top, right, bottom] boxes
+    width = min(bbox[2], other[2]) - max(bbox[0], other[0])
+    height = min(bbox[3], other[3]) - max(bbox[1], other[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    area = (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) + (other[2] - other[0]) * (other[3] - other[1])
+    return intersection / (area - intersection)
+
+
+class TrackingSession(object):
+    """
+    The face of successive frames sent by one client. The face is detected in the first frame and followed
+    with a correlation tracker, as in core.demo, and only detected again once the tracker loses it.
+    The matches of a frame are reused for the next ones while the face stays where it was matched.
+    """
+
+    def __init__(self):
+        self.tracker = correlation_tracker()
+        self.lock = Lock()  # frames of a session are handled one at a time, in order
+        self.bbox = None
+        self.matched_bbox = None
+        self.reused = 0
+        self.last_seen = time.time()
+
+    def locate(self, frame, face_detector, min_confidence):
+        # returns the [left, top, right, bottom] box of the face in frame, or None if there is no face
+        height, width = frame.shape[:2]
+        if self.bbox is not None and self.tracker.update(frame) >= min_confidence:
+            position = self.tracker.get_position()
+            self.bbox = [max(int(position.left()), 0), max(int(position.top()), 0),
+                         min(int(position.right()), width), min(int(position.bottom()), height)]
+            return self.bbox
+
+        faces = list(face_detector(frame))
+        self.bbox, self.matched_bbox = None, None
+        if faces:
+            self.bbox = max(faces, key=lambda bbox: (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]))
+            self.tracker.start_track(frame, Rectangle(*self.bbox))
+        return self.bbox
+
+    def reuse(self, min_overlap, max_reuse):
+        # whether the matches of a previous frame still hold, matches are refreshed every max_reuse frames
+        # even if the face stays still, so that changes of expression are followed
+        if self.matched_bbox is None or self.reused >= max_reuse or overlap(self.bbox, self.matched_bbox) < min_overlap:
+            return False
+        self.reused += 1
+        return True
+
+    def matched(self):
+        self.matched_bbox, self.reused = self.bbox, 0
+
+
+class TrackingSessions(object):
+    """
+    Sessions by the id chosen by the client. Sessions not seen for timeout seconds are dropped.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.sessions = {}
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get(self, session_id):
+        now = time.time()
+        with self.lock:
+            expired = [key for key, session in self.sessions.items() if now - session.last_seen > self.timeout]
+            for key in expired:
+                del self.sessions[key]
+            if session_id not in self.sessions:
+                self.sessions[session_id] = TrackingSession()
+            session = self.sessions[session_id]
+            session.last_seen = now
+            return session
+
+    def close(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
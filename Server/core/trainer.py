@@ -1,28 +1,24 @@
 import os
 import glob
 import shutil
-from multiprocessing import Manager
+from multiprocessing import Manager, cpu_count
 
 import numpy as np
-from sklearn.neighbors import NearestNeighbors
 from skimage import io
 from skimage.transform import resize
 from icrawler.builtin import GoogleImageCrawler
-from mysql.connector import Error as sqlError
 from sklearn.svm import SVC
 from sklearn.externals import joblib
 
-from core import detector
+from core import detector, extraction
 from core.comparator import Comparator
-from database import paintingDB
-from database.modelDB import dataset_dir, emotions, ModelDatabaseHandler
+from database import paintingDB, dataset_dir, ModelDatabaseHandler
 
 
 def examine(params):
     try:
         trainer, weight, neighbors, processed, total = params
-        match_rate = trainer.verify_model(Comparator.construct_metric(weight),
-                                          neighbors=neighbors, verbose=False)
+        match_rate = trainer.verify_model(weight, neighbors=neighbors, verbose=False)
         processed.value += 1
         print("({}/{}) {} -> {:.2f}%".format(processed.value, total, weight, match_rate * 100.0))
         return weight, match_rate
@@ -34,12 +30,9 @@ def examine(params):
 class Trainer(object):
     def __init__(self, pool_branch="Pool", training_branch="Training"):
         db_handler = ModelDatabaseHandler()
-        pool = db_handler.get_landmarks(pool_branch)
-        self.emotions_pool = np.array([row[1] for row in pool])
-        self.landmarks_pool = np.array([row[3] for row in pool])
-        training = db_handler.get_landmarks(training_branch)
-        self.emotions_training = [row[1] for row in training]
-        self.landmarks_training = np.array([row[3] for row in training])
+        _, self.emotions_pool, self.landmarks_pool = db_handler.load_landmarks(pool_branch)
+        _, emotions_training, self.landmarks_training = db_handler.load_landmarks(training_branch)
+        self.emotions_training = emotions_training.tolist()
 
     @staticmethod
     def crawl_image(keyword, capacity, directory):
@@ -87,59 +80,18 @@ class Trainer(object):
         shutil.rmtree(tmp_dir)
 
     @staticmethod
-    def build_database(directory=dataset_dir):
-        total_dir = os.path.join(directory, "total")
-        if os.path.exists(total_dir):
-            print("Total directory already exists")
-            exit(-1)
-        os.makedirs(total_dir)
+    def build_database(directory=dataset_dir, num_process=cpu_count()):
+        # extracted in parallel and resumable, see core.extraction
+        extraction.build_database(directory, num_process)
 
-        db_handler = ModelDatabaseHandler()
-        try:
-            copied = 0
-            for emotion, emotion_id in zip(emotions, range(len(emotions))):
-                print("Processing {}...".format(emotion))
-
-                files = glob.glob(os.path.join(os.path.join(directory, emotion), "*.jpg"))
-                total, processed = len(files), 0
-                branch = [[name, int(count)] for name, count in
-                          zip(["Training", "Test"], [total * i for i in [0.8, 0.2]])]
-
-                def get_database_branch():
-                    branch[-1][1] -= 1
-                    branch_name = branch[-1][0]
-                    if not branch[-1][1] and len(branch) > 1:
-                        branch.pop()
-                    return branch_name
-
-                for img_file in files:
-                    processed += 1
-                    img_data = io.imread(img_file)
-                    bounding_box = detector.create_rect(0, 0, img_data.shape[1], img_data.shape[0])
-                    landmarks = detector.detect_landmarks(img_data, bounding_box)
-                    normalized = detector.normalize_landmarks(landmarks).tolist()
-                    posed = detector.pose_landmarks(landmarks).tolist()
-
-                    copied += 1
-                    db_handler.store_landmarks(get_database_branch(), emotion_id, normalized, posed)
-                    db_handler.store_landmarks("Total", emotion_id, normalized, posed)
-                    # shutil.copy(img_file, os.path.join(total_dir, str(copied).zfill(5) + ".jpg"))
-
-                    print("Processed ({}/{})".format(processed, total))
-
-        except sqlError as err:
-            print("Error in MySQL: {}".format(err))
-
-        finally:
-            db_handler.commit_change()
-
-    def verify_model(self, metric, neighbors=1, verbose=True):
-        neighbors = NearestNeighbors(metric=metric, n_neighbors=neighbors).fit(self.landmarks_pool)
+    def verify_model(self, weight=None, neighbors=1, verbose=True):
+        comparator = Comparator(self.landmarks_pool, neighbors, weight)
         total, processed, match = len(self.emotions_training), 0, 0
 
-        for emotion_id, points_posed in zip(self.emotions_training, self.landmarks_training):
+        matches = comparator.batch(self.landmarks_training)
+
+        for emotion_id, match_id in zip(self.emotions_training, matches):
             processed += 1
-            match_id = neighbors.kneighbors([points_posed], return_distance=False)[0]
             match_emotions = self.emotions_pool[match_id].tolist()
             if emotion_id == max(match_emotions, key=match_emotions.count):
                 match += 1
@@ -177,17 +129,12 @@ class Trainer(object):
 
 def train_svm(directory=paintingDB.svm_dir):
     db_handler = ModelDatabaseHandler()
-    training_pool = db_handler.get_landmarks("Training")
-    test_pool = db_handler.get_landmarks("Test")
+    _, training_label, training_data = db_handler.load_landmarks("Training")
+    _, test_label, test_data = db_handler.load_landmarks("Test")
 
     def generate_train_data():
-        np.random.shuffle(training_pool)
-        label = np.array([row[1] for row in training_pool])
-        data = np.array([row[3] for row in training_pool])
-        return data, label
-
-    test_label = np.array([row[1] for row in test_pool])
-    test_data = np.array([row[3] for row in test_pool])
+        order = np.random.permutation(len(training_label))
+        return training_data[order], training_label[order]
 
     svm = SVC(kernel='linear', probability=True, tol=1e-3)
     training_data, training_label = generate_train_data()
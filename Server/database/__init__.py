@@ -4,18 +4,22 @@ from .paintingDB import PaintingDatabaseHandler
 from .modelDB import ModelDatabaseHandler
 
 __all__ = ["PaintingDatabaseHandler", "ModelDatabaseHandler",
-           "paintings_dir", "faces_dir", "temp_dir",
-           "models_dir", "predictor_path", "style_path",
-           "svm_path", "dataset_dir", "emotions", "emotions_dir"]
+           "paintings_dir", "faces_dir", "derivative_dir", "temp_dir",
+           "models_dir", "predictor_path", "style_path", "preview_path",
+           "svm_path", "gallery_dir", "dataset_dir", "database_dir", "emotions", "emotions_dir"]
 
 resource_dir   = "/Users/lun/Desktop/ProjectX"
 paintings_dir  = os.path.join(resource_dir, "paintings")
 faces_dir      = os.path.join(resource_dir, "faces")
+derivative_dir = os.path.join(resource_dir, "derivatives")
 temp_dir       = os.path.join(resource_dir, "temp")
+database_dir   = os.path.join(resource_dir, "database")  # files of the sqlite backend
 models_dir     = os.path.join(resource_dir, "models")
 predictor_path = os.path.join(models_dir, "predictor.dat")
 style_path     = os.path.join(models_dir, "style150.h5")
+preview_path   = os.path.join(models_dir, "style150_preview.h5")  # same styles with width_factor=1, optional
 svm_path       = os.path.join(models_dir, "svm.pkl")
+gallery_dir    = os.path.join(models_dir, "gallery")
 dataset_dir    = os.path.join(models_dir, "dataset")
 emotions       = ["angry", "disgust", "fear", "happy", "neutral", "sad", "surprise"]
 emotions_dir   = [os.path.join(dataset_dir, emotion) for emotion in emotions]
@@ -1,21 +1,377 @@
-import mysql.connector
+from queue import Queue, Empty
+from threading import Lock, current_thread, local
+import os
+import sqlite3
+import time
+import weakref
+
+import numpy as np
+try:
+    import mysql.connector
+except ImportError:
+    mysql = None  # only the sqlite backend is available
+
+backend = "mysql"  # "mysql" for the local MySQL server, "sqlite" for files under database_dir
+connect_args = {"user": "root", "password": "password", "host": "localhost"}
+pool_size = 8  # connections per database and process
+chunk_size = 1000  # rows fetched at a time by the streaming loaders, which only hold one chunk besides their result
+pool_timeout = 30  # seconds to wait for a free connection before raising PoolTimeoutError
+health_check_interval = 60  # connections idle for longer are checked, and reconnected if stale, when acquired
+
+
+class MySQLBackend(object):
+    name = "mysql"
+    placeholder = "%s"
+
+    @property
+    def errors(self):
+        return mysql.connector.Error
+
+    @staticmethod
+    def connect(database):
+        return mysql.connector.connect(database=database, **connect_args)
+
+    @staticmethod
+    def cursor(cnx):
+        return cnx.cursor(buffered=True)
+
+    @staticmethod
+    def stream_cursor(cnx):
+        # rows stay on the server until fetched, the connection runs nothing else until they are all read
+        return cnx.cursor(buffered=False)
+
+    @staticmethod
+    def finish(cnx, cursor):
+        if cnx.unread_result:
+            cnx.consume_results()
+        cursor.close()
+
+    @staticmethod
+    def begin(cnx):
+        cnx.start_transaction()
+
+    @staticmethod
+    def is_connected(cnx):
+        return cnx.is_connected()
+
+    @staticmethod
+    def reconnect(cnx):
+        cnx.reconnect(attempts=3, delay=1)
+
+
+class SQLiteBackend(object):
+    """
+    One file per database. Write-ahead logging lets readers run while a writer commits, and the module
+    keeps the prepared statements of each connection in its statement cache. Tables are created by the
+    handlers from their sqlite_schema, with landmark columns as BLOB from the start.
+    """
+
+    name = "sqlite"
+    placeholder = "?"
+    errors = sqlite3.Error
+
+    @staticmethod
+    def path(database):
+        from database import database_dir
+        if not os.path.exists(database_dir):
+            os.makedirs(database_dir)
+        return os.path.join(database_dir, f"{database}.db")
+
+    @classmethod
+    def connect(cls, database):
+        # connections move between threads through the pool, but are only used by one thread at a time
+        cnx = sqlite3.connect(cls.path(database), timeout=pool_timeout, check_same_thread=False,
+                              cached_statements=256)
+        cnx.execute("PRAGMA journal_mode=WAL")
+        cnx.execute("PRAGMA synchronous=NORMAL")
+        return cnx
+
+    @staticmethod
+    def cursor(cnx):
+        return cnx.cursor()
+
+    @staticmethod
+    def stream_cursor(cnx):
+        # sqlite cursors step through the result as rows are fetched
+        return cnx.cursor()
+
+    @staticmethod
+    def finish(cnx, cursor):
+        cursor.close()
+
+    @staticmethod
+    def begin(cnx):
+        cnx.execute("BEGIN")
+
+    @staticmethod
+    def is_connected(cnx):
+        return True
+
+    @staticmethod
+    def reconnect(cnx):
+        pass
+
+
+backends = {"mysql": MySQLBackend(), "sqlite": SQLiteBackend()}
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    At most size connections to one database, opened on demand and reused once released.
+    acquire waits up to timeout seconds when all of them are in use, and keeps count of the waits.
+    """
+
+    def __init__(self, backend, database, size=pool_size, timeout=pool_timeout):
+        self.backend = backend
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.idle = Queue()  # (connection, time it was released)
+        self.created = 0
+        self.lock = Lock()
+        self.acquired, self.waited, self.timeouts, self.reconnects = 0, 0, 0, 0
+        self.wait_time, self.max_wait = 0.0, 0.0
+
+    def acquire(self):
+        start = time.time()
+        try:
+            cnx, released = self.idle.get_nowait()
+        except Empty:
+            with self.lock:
+                can_create = self.created < self.size
+                self.created += can_create
+            if can_create:
+                try:
+                    cnx, released = self.backend.connect(self.database), time.time()
+                except Exception:
+                    self.discard()
+                    raise
+            else:
+                try:
+                    cnx, released = self.idle.get(timeout=self.timeout)
+                except Empty:
+                    with self.lock:
+                        self.timeouts += 1
+                    raise PoolTimeoutError(f"No connection to '{self.database}' free after {self.timeout}s")
+
+        waited = time.time() - start
+        with self.lock:
+            self.acquired += 1
+            self.waited += waited > 0.001
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+
+        # the server closes connections idle for longer than its wait_timeout
+        if time.time() - released > health_check_interval and not self.backend.is_connected(cnx):
+            try:
+                self.backend.reconnect(cnx)
+            except self.backend.errors:
+                self.discard()
+                raise
+            with self.lock:
+                self.reconnects += 1
+        return cnx
+
+    def release(self, cnx):
+        try:
+            if cnx.in_transaction:
+                cnx.rollback()
+        except self.backend.errors:
+            # a broken connection is not reused, another one is opened instead
+            self.discard()
+            return
+        self.idle.put((cnx, time.time()))
+
+    def discard(self):
+        with self.lock:
+            self.created -= 1
+
+    def stats(self):
+        with self.lock:
+            return {"size": self.size,
+                    "open": self.created,
+                    "idle": self.idle.qsize(),
+                    "acquired": self.acquired,
+                    "waited": self.waited,
+                    "mean_wait": self.wait_time / self.acquired if self.acquired else 0.0,
+                    "max_wait": self.max_wait,
+                    "timeouts": self.timeouts,
+                    "reconnects": self.reconnects}
+
+
+_pools = {}
+_pools_lock = Lock()
+
+
+def get_pool(backend, database):
+    # connections cannot be shared with forked processes, so each process has its own pools
+    key = (os.getpid(), backend.name, database)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(backend, database)
+        return _pools[key]
+
+
+def close_pool(backend_name, database):
+    # closes the idle connections, those still held are closed when they are garbage collected
+    with _pools_lock:
+        pool = _pools.pop((os.getpid(), backend_name, database), None)
+    while pool is not None and not pool.idle.empty():
+        pool.idle.get()[0].close()
 
 
 class DatabaseHandler(object):
+    """
+    Each thread using a handler gets its own connection from the pool of the database, and its own
+    buffered cursor, on first access. release returns the connection of the calling thread to the pool,
+    which also happens when the thread ends. A handler used in a forked process opens its own connections
+    there, from the pool of that process.
 
-    def __init__(self, database):
+    Statements are written with %s placeholders, and run through execute / executemany,
+    which adapt them to the backend.
+    """
+
+    sqlite_schema = []  # CREATE TABLE statements run when a sqlite database is opened
+
+    def __init__(self, database, backend_name=None):
         self.database = database
-        self.cnx = mysql.connector.connect(user="root",
-                                           password="password",
-                                           host="localhost",
-                                           database=database)
-        self.cursor = self.cnx.cursor(buffered=True)
+        self.backend = backends[backend_name or backend]
+        self.pool = get_pool(self.backend, database)
+        self.local = local()
+        if self.backend.name == "sqlite":
+            [self.execute(statement) for statement in self.sqlite_schema]
+            self.cnx.commit()
+            self.release()
+
+    def _check_fork(self):
+        # a forked process inherits the pool and the connection of the thread that forked, both belong to the parent
+        if getattr(self.local, "pid", None) == os.getpid():
+            return
+        if getattr(self.local, "finalizer", None) is not None:
+            self.local.finalizer.detach()
+        # the inherited connection is dropped without closing it, closing would end the session of the parent
+        self.local.cnx, self.local.cursor, self.local.finalizer = None, None, None
+        self.local.pid = os.getpid()
+        self.pool = get_pool(self.backend, self.database)
+
+    @property
+    def cnx(self):
+        self._check_fork()
+        if getattr(self.local, "cnx", None) is None:
+            cnx = self.pool.acquire()
+            self.local.cnx, self.local.cursor = cnx, self.backend.cursor(cnx)
+            self.local.finalizer = weakref.finalize(current_thread(), self.pool.release, cnx)
+            self.local.finalizer.atexit = False
+        return self.local.cnx
+
+    @property
+    def cursor(self):
+        self.cnx  # acquires the connection of this thread if it has none
+        return self.local.cursor
+
+    def execute(self, statement, params=()):
+        self.cursor.execute(statement.replace("%s", self.backend.placeholder), params)
+        return self.cursor
+
+    def executemany(self, statement, rows):
+        self.cursor.executemany(statement.replace("%s", self.backend.placeholder), rows)
+        return self.cursor
+
+    def stream(self, statement, params=(), size=None):
+        # yields the rows of a query in lists of at most size rows, without holding the whole result
+        cursor = self.backend.stream_cursor(self.cnx)
+        try:
+            cursor.execute(statement.replace("%s", self.backend.placeholder), params)
+            rows = cursor.fetchmany(size or chunk_size)
+            while rows:
+                yield rows
+                rows = cursor.fetchmany(size or chunk_size)
+        finally:
+            self.backend.finish(self.cnx, cursor)
+
+    def release(self):
+        # uncommitted changes are rolled back
+        self._check_fork()
+        if getattr(self.local, "cnx", None) is None:
+            return
+        self.local.finalizer.detach()
+        self.local.cursor.close()
+        self.pool.release(self.local.cnx)
+        self.local.cnx, self.local.cursor, self.local.finalizer = None, None, None
 
     def commit(self):
         self.cnx.commit()
         print(f"Database '{self.database}' committed")
 
     def close(self):
-        self.cursor.close()
-        self.cnx.close()
+        self.release()
         print(f"Database '{self.database}' closed")
+
+
+def fill_arrays(arrays, chunks):
+    """
+    Copy chunks of aligned arrays into the preallocated arrays, row after row. The arrays grow if
+    rows were inserted after they were counted, and are trimmed to the rows actually copied.
+    """
+    filled = 0
+    for chunk in chunks:
+        end = filled + len(chunk[0])
+        if end > len(arrays[0]):
+            arrays = [np.concatenate([array, np.empty((end - len(array),) + array.shape[1:], dtype=array.dtype)])
+                      for array in arrays]
+        for array, values in zip(arrays, chunk):
+            array[filled: end] = values
+        filled = end
+    return tuple(array[:filled] for array in arrays)
+
+
+class BatchWriter(object):
+    """
+    Buffer the rows of an INSERT statement and write them with executemany, which the connector sends
+    as multi-row INSERTs, every batch_size rows. Each flush runs in its own transaction, committed unless
+    commit is False, in which case the caller commits. Used as a context manager, the remaining rows are
+    flushed on exit, and dropped if the block raised.
+    """
+
+    def __init__(self, db_handler, statement, batch_size=1000, encode=None, commit=True):
+        self.db_handler = db_handler
+        self.statement = statement
+        self.batch_size = batch_size
+        self.encode = encode
+        self.commit = commit
+        self.rows = []
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.rows = []
+
+    def add(self, *row):
+        self.rows.append(self.encode(*row) if self.encode else row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        cnx = self.db_handler.cnx
+        if not cnx.in_transaction:
+            self.db_handler.backend.begin(cnx)
+        try:
+            self.db_handler.executemany(self.statement, self.rows)
+            if self.commit:
+                cnx.commit()
+        except Exception:
+            cnx.rollback()
+            raise
+        self.written += len(self.rows)
+        self.rows = []
@@ -0,0 +1,142 @@
+"""
+Throughput of landmark writes and loads.
+
+benchmark_writes: one INSERT per row, as build_database used to do, against BatchWriter at several batch sizes,
+into a scratch copy of the Total table.
+
+benchmark_backends: batched inserts and array loads of the Total and Landmark tables for each storage backend,
+in scratch databases dropped afterwards. Loads are timed with the whole result fetched at once and with the
+streaming load_landmarks, along with the peak memory traced while loading.
+
+python -m database.benchmark [rows ...]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from . import baseDB, codec
+from .modelDB import ModelDatabaseHandler
+from .paintingDB import PaintingDatabaseHandler
+
+scratch_table = "BenchmarkLandmark"
+scratch_suffix = "_benchmark"
+# the columns read by load_landmarks for each table
+load_statements = {"Total": "SELECT id, emotion_id, points_posed FROM Total",
+                   "Landmark": "SELECT id, painting_id, emotion_id, points FROM Landmark"}
+
+
+def single_rows(db_handler, rows):
+    for row in rows:
+        db_handler.store_landmarks(scratch_table, *row)
+    db_handler.commit()
+
+
+def batched_rows(db_handler, rows, batch_size):
+    with db_handler.landmark_writer(scratch_table, batch_size) as writer:
+        for row in rows:
+            writer.add(*row)
+
+
+def buffered_load(db_handler, table):
+    # the whole result fetched, then decoded at once, as the handlers did before load_landmarks streamed it
+    *columns, points = zip(*db_handler.execute(load_statements[table]).fetchall())
+    return tuple(np.array(column, dtype=np.int64) for column in columns) + (codec.decode_all(points, 136),)
+
+
+def random_rows(size):
+    points = np.random.rand(size, 2, 136).astype(np.float32)
+    return [(i % 7, points[i, 0], points[i, 1]) for i in range(size)]
+
+
+def benchmark_writes(sizes=(10000, 100000), batch_sizes=(100, 1000, 5000)):
+    db_handler = ModelDatabaseHandler(backend_name="mysql")
+    db_handler.execute(f"DROP TABLE IF EXISTS {scratch_table}")
+    db_handler.execute(f"CREATE TABLE {scratch_table} LIKE Total")
+    try:
+        for size in sizes:
+            rows = random_rows(size)
+            runs = [("single rows", lambda: single_rows(db_handler, rows))]
+            runs += [(f"batches of {batch_size}", lambda batch_size=batch_size: batched_rows(db_handler, rows, batch_size))
+                     for batch_size in batch_sizes]
+            for name, run in runs:
+                db_handler.execute(f"TRUNCATE TABLE {scratch_table}")
+                start = time.time()
+                run()
+                elapsed = time.time() - start
+                print(f"{size:>7} rows, {name:<18} {elapsed:8.2f}s  {size / elapsed:10.0f} rows/s")
+    finally:
+        db_handler.execute(f"DROP TABLE IF EXISTS {scratch_table}")
+        db_handler.close()
+
+
+def create_scratch(backend_name):
+    # sqlite handlers create their tables when opened, MySQL copies the definitions of the real tables
+    if backend_name == "mysql":
+        db_handler = ModelDatabaseHandler(backend_name="mysql")
+        for database, table in [("model", "Total"), ("paintings", "Landmark")]:
+            db_handler.execute(f"CREATE DATABASE IF NOT EXISTS {database}{scratch_suffix}")
+            db_handler.execute(f"CREATE TABLE {database}{scratch_suffix}.{table} LIKE {database}.{table}")
+        db_handler.close()
+    return (ModelDatabaseHandler("model" + scratch_suffix, backend_name),
+            PaintingDatabaseHandler("paintings" + scratch_suffix, backend_name))
+
+
+def drop_scratch(backend_name, handlers):
+    [db_handler.close() for db_handler in handlers]
+    for database in ["model" + scratch_suffix, "paintings" + scratch_suffix]:
+        if backend_name == "mysql":
+            db_handler = ModelDatabaseHandler(backend_name="mysql")
+            db_handler.execute(f"DROP DATABASE IF EXISTS {database}")
+            db_handler.close()
+        else:
+            baseDB.close_pool(backend_name, database)
+            path = baseDB.backends[backend_name].path(database)
+            [os.remove(path + suffix) for suffix in ["", "-wal", "-shm"] if os.path.isfile(path + suffix)]
+
+
+def benchmark_backends(sizes=(10000, 100000), batch_size=1000, backend_names=("mysql", "sqlite")):
+    for backend_name in backend_names:
+        model_handler, painting_handler = create_scratch(backend_name)
+        try:
+            for size in sizes:
+                # every size starts from empty tables, so that loads only time the rows of this size
+                for db_handler, table in [(model_handler, "Total"), (painting_handler, "Landmark")]:
+                    db_handler.execute(f"DELETE FROM {table}")
+                    db_handler.cnx.commit()
+                rows = random_rows(size)
+                runs = [("Total", lambda: model_handler.landmark_writer("Total", batch_size),
+                         [("buffered", lambda: buffered_load(model_handler, "Total")),
+                          ("streamed", lambda: model_handler.load_landmarks("Total"))],
+                         lambda row: row),
+                        ("Landmark", lambda: painting_handler.landmark_writer(batch_size),
+                         [("buffered", lambda: buffered_load(painting_handler, "Landmark")),
+                          ("streamed", lambda: painting_handler.load_landmarks())],
+                         lambda row: (1, row[0], [0, 0, 100, 100], row[1], row[2]))]
+                for table, writer, loads, to_row in runs:
+                    start = time.time()
+                    with writer() as opened:
+                        [opened.add(*to_row(row)) for row in rows]
+                    insert_time = time.time() - start
+                    print(f"{backend_name:<6} {table:<8} {size:>7} rows inserted {size / insert_time:10.0f} rows/s")
+                    for name, load in loads:
+                        tracemalloc.start()
+                        start = time.time()
+                        loaded = len(load()[0])
+                        load_time = time.time() - start
+                        peak = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+                        print(f"{backend_name:<6} {table:<8} {loaded:>7} rows {name} "
+                              f"{loaded / load_time:10.0f} rows/s, peak {peak / 2 ** 20:8.1f} MiB")
+        finally:
+            drop_scratch(backend_name, (model_handler, painting_handler))
+
+
+if __name__ == "__main__":
+    sizes = tuple(int(size) for size in sys.argv[1:]) or (10000, 100000)
+    if baseDB.mysql is not None:
+        benchmark_writes(sizes)
+    benchmark_backends(sizes, backend_names=("mysql", "sqlite") if baseDB.mysql is not None else ("sqlite",))
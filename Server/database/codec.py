@@ -0,0 +1,43 @@
+"""
+Binary format of the landmark columns (points, points_posed and the bbox of Landmark): a 4 byte header,
+b"LM" and the format version as a little-endian unsigned short, followed by little-endian float32 values.
+Values written before the migration are JSON text, which is still decoded.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+__all__ = ["version", "encode", "decode", "decode_all"]
+
+version = 1
+header = struct.pack("<2sH", b"LM", version)
+dtype = np.dtype("<f4")
+
+
+def is_binary(value):
+    return isinstance(value, (bytes, bytearray)) and value[:len(header)] == header
+
+
+def encode(values):
+    return header + np.asarray(values, dtype=dtype).tobytes()
+
+
+def decode(value):
+    if is_binary(value):
+        return np.frombuffer(value, dtype=dtype, offset=len(header))
+    return np.array(json.loads(value), dtype=dtype)
+
+
+def decode_all(values, width):
+    """
+    Decode the values of a column into one array of shape (len(values), width).
+    When every value is binary, the result set is decoded by a single np.frombuffer: the header of
+    each row is read as one more float32 column, and dropped.
+    """
+    row_size = len(header) + width * dtype.itemsize
+    if all(len(value) == row_size and is_binary(value) for value in values):
+        rows = np.frombuffer(b"".join(values), dtype=dtype).reshape(len(values), width + 1)
+        return rows[:, 1:]
+    return np.array([decode(value) for value in values], dtype=dtype).reshape(len(values), width)
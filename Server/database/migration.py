@@ -0,0 +1,43 @@
+"""
+One-shot migration of the landmark columns from JSON to the binary format of database.codec.
+Only tables of the MySQL backend need it, the sqlite backend creates them binary.
+The columns are first changed to BLOB, which keeps their JSON text, then every row that is not binary yet
+is rewritten. Rows already migrated are skipped, so it can be run again after an interruption.
+
+python -m database.migration
+"""
+
+from . import codec
+from .modelDB import ModelDatabaseHandler
+from .paintingDB import PaintingDatabaseHandler
+
+chunk_size = 1000  # rows rewritten per commit
+
+tables = [(ModelDatabaseHandler, table, ["points", "points_posed"]) for table in ["Total", "Training", "Test", "Pool"]]
+tables.append((PaintingDatabaseHandler, "Landmark", ["bbox", "points", "points_posed"]))
+
+
+def migrate_table(db_handler, table, columns):
+    for column in columns:
+        db_handler.cursor.execute(f"ALTER TABLE {table} MODIFY {column} BLOB NOT NULL")
+
+    db_handler.cursor.execute(f"SELECT id, {', '.join(columns)} FROM {table}")
+    rows = [(row[1:], row[0]) for row in db_handler.cursor.fetchall()
+            if not all(codec.is_binary(value) for value in row[1:])]
+    update = f"UPDATE {table} SET {', '.join(f'{column}=%s' for column in columns)} WHERE id=%s"
+    for start in range(0, len(rows), chunk_size):
+        db_handler.cursor.executemany(update, [tuple(codec.encode(codec.decode(value)) for value in values) + (lid,)
+                                               for values, lid in rows[start: start + chunk_size]])
+        db_handler.commit()
+    print(f"{table}: {len(rows)} rows migrated")
+
+
+def migrate():
+    for handler_class, table, columns in tables:
+        db_handler = handler_class(backend_name="mysql")
+        migrate_table(db_handler, table, columns)
+        db_handler.close()
+
+
+if __name__ == "__main__":
+    migrate()
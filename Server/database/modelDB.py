@@ -1,6 +1,7 @@
-import json
+import numpy as np
 
-from .baseDB import DatabaseHandler
+from .baseDB import DatabaseHandler, BatchWriter, fill_arrays
+from . import codec
 
 """
 mysql> use model
@@ -11,9 +12,11 @@ mysql> DESCRIBE Total;
 +--------------+---------+------+-----+---------+----------------+
 | id           | int(11) | NO   | PRI | NULL    | auto_increment |
 | emotion_id   | int(11) | NO   |     | NULL    |                |
-| points       | json    | NO   |     | NULL    |                |
-| points_posed | json    | NO   |     | NULL    |                |
+| points       | blob    | NO   |     | NULL    |                |
+| points_posed | blob    | NO   |     | NULL    |                |
 +--------------+---------+------+-----+---------+----------------+
+
+points and points_posed are encoded by database.codec, run "python -m database.migration" on JSON tables.
 """
 
 
@@ -25,15 +28,57 @@ class ModelDatabaseHandler(DatabaseHandler):
                                 "(emotion_id, points, points_posed)",
                                 "VALUES (%s, %s, %s)"))
 
-    def __init__(self):
-        super().__init__("model")
+    query_columns = "SELECT id, emotion_id, {} FROM {}"
+
+    count_rows = "SELECT COUNT(*) FROM {}"
+
+    query_last_id = "SELECT COALESCE(MAX(id), 0) FROM {}"
+
+    delete_landmarks_after = "DELETE FROM {} WHERE id > %s"
+
+    sqlite_schema = [" ".join(("CREATE TABLE IF NOT EXISTS {}".format(table),
+                               "(id INTEGER PRIMARY KEY AUTOINCREMENT, emotion_id INTEGER NOT NULL,",
+                               "points BLOB NOT NULL, points_posed BLOB NOT NULL)"))
+                     for table in ["Total", "Training", "Test", "Pool"]]
+
+    def __init__(self, database="model", backend_name=None):
+        super().__init__(database, backend_name)
 
     def get_landmarks(self, branch):
-        self.cursor.execute(self.query_landmarks.format(branch))
-        return [(landmark_id, emotion_id, json.loads(points), json.loads(points_posed))
+        self.execute(self.query_landmarks.format(branch))
+        return [(landmark_id, emotion_id, codec.decode(points).tolist(), codec.decode(points_posed).tolist())
                 for landmark_id, emotion_id, points, points_posed in self.cursor]
 
+    def iter_landmarks(self, branch, column="points_posed", size=None):
+        # yields chunks of (ids, emotion ids, points of shape (n, 136)), column is "points" or "points_posed"
+        for rows in self.stream(self.query_columns.format(column, branch), size=size):
+            ids, emotion_ids, points = zip(*rows)
+            yield (np.array(ids, dtype=np.int64), np.array(emotion_ids, dtype=np.int64),
+                   codec.decode_all(points, 136))
+
+    def load_landmarks(self, branch, column="points_posed", size=None):
+        # (ids, emotion ids, points) of the whole table, filled chunk by chunk into preallocated arrays
+        self.execute(self.count_rows.format(branch))
+        total = self.cursor.fetchone()[0]
+        arrays = [np.empty(total, dtype=np.int64), np.empty(total, dtype=np.int64),
+                  np.empty([total, 136], dtype=codec.dtype)]
+        return fill_arrays(arrays, self.iter_landmarks(branch, column, size))
+
     def store_landmarks(self, branch, emotion_id, points, points_posed):
-        self.cursor.execute(self.insert_landmark.format(branch),
-                            (emotion_id, json.dumps(points), json.dumps(points_posed)))
+        self.execute(self.insert_landmark.format(branch),
+                     (emotion_id, codec.encode(points), codec.encode(points_posed)))
         return self.cursor.lastrowid
+
+    def landmark_writer(self, branch, batch_size=1000, commit=True):
+        # add(emotion_id, points, points_posed) for each row
+        return BatchWriter(self, self.insert_landmark.format(branch), batch_size,
+                           lambda emotion_id, points, points_posed:
+                           (emotion_id, codec.encode(points), codec.encode(points_posed)), commit)
+
+    def get_last_id(self, branch):
+        self.execute(self.query_last_id.format(branch))
+        return self.cursor.fetchone()[0]
+
+    def delete_after(self, branch, last_id):
+        self.execute(self.delete_landmarks_after.format(branch), (last_id,))
+        return self.cursor.rowcount
@@ -1,6 +1,9 @@
 import json
 
-from .baseDB import DatabaseHandler
+import numpy as np
+
+from .baseDB import DatabaseHandler, BatchWriter, fill_arrays
+from . import codec
 
 """
 mysql> use paintings
@@ -29,10 +32,13 @@ mysql> DESCRIBE Landmark;
 +--------------+---------+------+-----+---------+----------------+
 | id           | int(11) | NO   | PRI | NULL    | auto_increment |
 | painting_id  | int(11) | NO   | MUL | NULL    |                |
-| bbox         | json    | NO   |     | NULL    |                |
-| points       | json    | NO   |     | NULL    |                |
-| points_posed | json    | NO   |     | NULL    |                |
+| emotion_id   | int(11) | NO   |     | NULL    |                |
+| bbox         | blob    | NO   |     | NULL    |                |
+| points       | blob    | NO   |     | NULL    |                |
+| points_posed | blob    | NO   |     | NULL    |                |
 +--------------+---------+------+-----+---------+----------------+
+
+The columns of Landmark are encoded by database.codec, run "python -m database.migration" on JSON tables.
 """
 
 
@@ -55,39 +61,103 @@ class PaintingDatabaseHandler(DatabaseHandler):
                                  "VALUES (%s, %s, %s)"))
 
     _insert_landmark = " ".join(("INSERT INTO Landmark",
-                                 "(painting_id, bbox, points, points_posed)",
-                                 "VALUES (%s, %s, %s, %s)"))
+                                 "(painting_id, emotion_id, bbox, points, points_posed)",
+                                 "VALUES (%s, %s, %s, %s, %s)"))
 
-    _query_all_landmarks = " ".join(("SELECT id, painting_id, bbox, points, points_posed",
+    _query_all_landmarks = " ".join(("SELECT id, painting_id, emotion_id, bbox, points, points_posed",
                                      "FROM Landmark"))
 
-    def __init__(self):
-        super().__init__("paintings")
+    _query_new_columns = " ".join(("SELECT id, painting_id, emotion_id, {}",
+                                   "FROM Landmark",
+                                   "WHERE id>%s",
+                                   "ORDER BY id"))
+
+    _count_landmarks = " ".join(("SELECT COUNT(*)",
+                                 "FROM Landmark",
+                                 "WHERE id<=%s"))
+
+    _count_new_landmarks = " ".join(("SELECT COUNT(*)",
+                                     "FROM Landmark",
+                                     "WHERE id>%s"))
+
+    sqlite_schema = [
+        "CREATE TABLE IF NOT EXISTS Download (id INTEGER PRIMARY KEY, url TEXT NOT NULL, bbox TEXT)",
+        "CREATE TABLE IF NOT EXISTS Painting (id INTEGER PRIMARY KEY, url TEXT NOT NULL, bbox TEXT NOT NULL)",
+        " ".join(("CREATE TABLE IF NOT EXISTS Landmark",
+                  "(id INTEGER PRIMARY KEY AUTOINCREMENT, painting_id INTEGER NOT NULL, emotion_id INTEGER NOT NULL,",
+                  "bbox BLOB NOT NULL, points BLOB NOT NULL, points_posed BLOB NOT NULL)")),
+        "CREATE INDEX IF NOT EXISTS painting_id ON Landmark (painting_id)",
+    ]
+
+    def __init__(self, database="paintings", backend_name=None):
+        super().__init__(database, backend_name)
 
     def did_download(self, index):
-        self.cursor.execute(self._query_download, (int(index),))
-        return self.cursor.rowcount
+        self.execute(self._query_download, (int(index),))
+        return self.cursor.fetchone() is not None
 
     def store_download(self, index, url):
-        self.cursor.execute(self._insert_download, (int(index), url))
+        self.execute(self._insert_download, (int(index), url))
         return self.cursor.rowcount
 
+    def download_writer(self, batch_size=1000, commit=True):
+        # add(index, url) for each row
+        return BatchWriter(self, self._insert_download, batch_size, lambda index, url: (int(index), url), commit)
+
     def update_bounding_box(self, index, bounding_box):
-        self.cursor.execute(self._update_download, (json.dumps(bounding_box), int(index)))
+        self.execute(self._update_download, (json.dumps(bounding_box), int(index)))
 
     def store_painting(self, index):
-        self.cursor.execute(self._query_download, (int(index),))
-        url, bounding_box = self.cursor[0]
-        self.cursor.execute(self._insert_painting, (int(index), url, bounding_box))
+        self.execute(self._query_download, (int(index),))
+        url, bounding_box = self.cursor.fetchone()
+        self.execute(self._insert_painting, (int(index), url, bounding_box))
         return json.loads(bounding_box)
 
-    def store_landmarks(self, painting_id, bounding_box, landmarks, landmarks_posed):
-        self.cursor.execute(self._insert_landmark,
-                            (int(painting_id), json.dumps(bounding_box),
-                             json.dumps(landmarks), json.dumps(landmarks_posed)))
+    def store_landmarks(self, painting_id, emotion_id, bounding_box, landmarks, landmarks_posed):
+        self.execute(self._insert_landmark,
+                     (int(painting_id), int(emotion_id), codec.encode(bounding_box),
+                      codec.encode(landmarks), codec.encode(landmarks_posed)))
         return self.cursor.lastrowid
 
+    def landmark_writer(self, batch_size=1000, commit=True):
+        # add(painting_id, emotion_id, bounding_box, landmarks, landmarks_posed) for each row
+        return BatchWriter(self, self._insert_landmark, batch_size,
+                           lambda painting_id, emotion_id, bounding_box, landmarks, landmarks_posed:
+                           (int(painting_id), int(emotion_id), codec.encode(bounding_box),
+                            codec.encode(landmarks), codec.encode(landmarks_posed)), commit)
+
+    @staticmethod
+    def _decode_rows(rows):
+        return [(lid, pid, eid, codec.decode(bbox).astype(int).tolist(),
+                 codec.decode(points).tolist(), codec.decode(points_posed).tolist())
+                for lid, pid, eid, bbox, points, points_posed in rows]
+
     def get_all_landmarks(self):
-        self.cursor.execute(self._query_all_landmarks)
-        return [(lid, pid, json.loads(bbox), json.loads(points), json.loads(points_posed))
-                for lid, pid, bbox, points, points_posed in self.cursor]
+        self.execute(self._query_all_landmarks)
+        return self._decode_rows(self.cursor)
+
+    def count_landmarks(self, last_id):
+        self.cnx.commit()
+        self.execute(self._count_landmarks, (int(last_id),))
+        return self.cursor.fetchone()[0]
+
+    def iter_landmarks(self, last_id=0, column="points", size=None):
+        """
+        Yields chunks of (ids, painting ids, emotion ids, points of shape (n, 136)) of the rows whose id is
+        larger than last_id, in id order. column is "points" or "points_posed".
+        """
+        # end the current transaction, otherwise its snapshot hides the rows committed since
+        self.cnx.commit()
+        for rows in self.stream(self._query_new_columns.format(column), (int(last_id),), size):
+            ids, painting_ids, emotion_ids, points = zip(*rows)
+            yield (np.array(ids, dtype=np.int64), np.array(painting_ids, dtype=np.int64),
+                   np.array(emotion_ids, dtype=np.int64), codec.decode_all(points, 136))
+
+    def load_landmarks(self, last_id=0, column="points", size=None):
+        # the chunks of iter_landmarks, filled into preallocated arrays
+        self.cnx.commit()
+        self.execute(self._count_new_landmarks, (int(last_id),))
+        total = self.cursor.fetchone()[0]
+        arrays = [np.empty(total, dtype=np.int64), np.empty(total, dtype=np.int64),
+                  np.empty(total, dtype=np.int64), np.empty([total, 136], dtype=codec.dtype)]
+        return fill_arrays(arrays, self.iter_landmarks(last_id, column, size))
@@ -1,3 +1,4 @@
 from .transfer import StyleTransfer
+from .scheduler import TransferScheduler
 
-__all__ = ["StyleTransfer"]
+__all__ = ["StyleTransfer", "TransferScheduler"]
@@ -0,0 +1,207 @@
+"""
+Export the pastiche net to frozen TensorFlow graphs for CPU inference, and compare them with the Keras model.
+
+An export directory holds:
+    pastiche.pb           all the styles, selected by the class targets input as in StyleTransfer
+    pastiche_<index>.pb   one style, with its conditional normalization parameters folded into constants
+    export.json           tensor names, quantization and style names
+Weights can be stored as float16 (cast back to float32 when the graph is loaded)
+or as 8-bit integers (with the quantize_weights graph transform).
+"""
+
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+import keras.backend as kb
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from transfer.transfer import StyleTransfer, session_config
+
+quantize_modes = (None, "float16", "int8")
+
+
+def freeze(style_transfer):
+    net = style_transfer.pastiche_net
+    names = {"input": net.input.op.name,
+             "output": net.output.op.name,
+             "targets": style_transfer.class_targets.op.name,
+             "learning_phase": kb.learning_phase().op.name}
+    graph_def = tf.graph_util.convert_variables_to_constants(style_transfer.session,
+                                                             style_transfer.session.graph.as_graph_def(),
+                                                             [names["output"]])
+    return graph_def, names
+
+
+def fold_style(graph_def, names, style_index):
+    # replace the class targets with a constant, so that the gathered gamma and beta become constants
+    learning_phase = next(node for node in graph_def.node if node.name == names["learning_phase"])
+    graph = tf.Graph()
+    with graph.as_default():
+        input_map = {names["targets"] + ":0": tf.constant([style_index], dtype=tf.int32),
+                     names["learning_phase"] + ":0": tf.constant(0, dtype=tf.as_dtype(learning_phase.attr["dtype"].type))}
+        tf.import_graph_def(graph_def, input_map=input_map, name="")
+    return TransformGraph(graph.as_graph_def(), [names["input"]], [names["output"]],
+                          ["strip_unused_nodes", "fold_constants(ignore_errors=true)"])
+
+
+def to_float16(graph_def, minimum_size=1024):
+    # store large float32 constants as float16, each followed by a cast back to float32
+    output = tf.GraphDef()
+    output.versions.CopyFrom(graph_def.versions)
+    output.library.CopyFrom(graph_def.library)
+    for node in graph_def.node:
+        if node.op == "Const" and node.attr["dtype"].type == tf.float32.as_datatype_enum:
+            value = tf.make_ndarray(node.attr["value"].tensor)
+            if value.size >= minimum_size:
+                half = output.node.add()
+                half.op, half.name = "Const", node.name + "/float16"
+                half.attr["dtype"].type = tf.float16.as_datatype_enum
+                half.attr["value"].tensor.CopyFrom(tf.make_tensor_proto(value.astype(np.float16)))
+                cast = output.node.add()
+                cast.op, cast.name = "Cast", node.name
+                cast.input.append(half.name)
+                cast.attr["SrcT"].type = tf.float16.as_datatype_enum
+                cast.attr["DstT"].type = tf.float32.as_datatype_enum
+                continue
+        output.node.add().CopyFrom(node)
+    return output
+
+
+def optimize(graph_def, names, quantize, inputs):
+    transforms = ["strip_unused_nodes", "fold_constants(ignore_errors=true)"]
+    if quantize == "int8":
+        transforms.append("quantize_weights")
+    graph_def = TransformGraph(graph_def, inputs, [names["output"]], transforms)
+    return to_float16(graph_def) if quantize == "float16" else graph_def
+
+
+def export(checkpoint_path, export_dir, quantize=None, style_indices=()):
+    if quantize not in quantize_modes:
+        raise ValueError("Expected quantize to be one of {}".format(quantize_modes))
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+
+    style_transfer = StyleTransfer(checkpoint_path)
+    graph_def, names = freeze(style_transfer)
+    inputs = [names["input"], names["targets"], names["learning_phase"]]
+    graphs = {"pastiche.pb": optimize(graph_def, names, quantize, inputs)}
+    for style_index in style_indices:
+        graphs["pastiche_{}.pb".format(style_index)] = optimize(fold_style(graph_def, names, style_index),
+                                                                names, quantize, [names["input"]])
+
+    for filename, graph in graphs.items():
+        with open(os.path.join(export_dir, filename), "wb") as f:
+            f.write(graph.SerializeToString())
+        StyleTransfer.print_with_date("Exported {} ({:.1f} MB)".format(
+            filename, os.path.getsize(os.path.join(export_dir, filename)) / 2 ** 20))
+
+    with open(os.path.join(export_dir, "export.json"), "w") as f:
+        json.dump({"names": names,
+                   "quantize": quantize,
+                   "style_indices": list(style_indices),
+                   "style_names": [name.decode("UTF-8") for name in style_transfer.style_names]}, f)
+
+
+class FrozenStyleTransfer(StyleTransfer):
+    """
+    Same interface as StyleTransfer, running an exported graph instead of the Keras model.
+    With style_index, the graph of that style is used, and only that style can be transferred.
+    """
+
+    def __init__(self, export_dir, style_index=None, intra_op_threads=0, inter_op_threads=0):
+        with open(os.path.join(export_dir, "export.json")) as f:
+            export_info = json.load(f)
+        names = export_info["names"]
+        self.style_names = [name.encode("UTF-8") for name in export_info["style_names"]]
+        self.style_index = style_index
+
+        filename = "pastiche.pb" if style_index is None else "pastiche_{}.pb".format(style_index)
+        graph_def = tf.GraphDef()
+        with open(os.path.join(export_dir, filename), "rb") as f:
+            graph_def.ParseFromString(f.read())
+        graph = tf.Graph()
+        with graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.session = tf.Session(graph=graph, config=session_config(intra_op_threads, inter_op_threads))
+
+        self.input = graph.get_tensor_by_name(names["input"] + ":0")
+        self.output = graph.get_tensor_by_name(names["output"] + ":0")
+        node_names = {node.name for node in graph_def.node}
+        self.targets = graph.get_tensor_by_name(names["targets"] + ":0") \
+            if names["targets"] in node_names else None
+        self.learning_phase = graph.get_tensor_by_name(names["learning_phase"] + ":0") \
+            if names["learning_phase"] in node_names else None
+
+    def transfer_batch(self, imgs, style_indices):
+        feed_dict = {self.input: imgs}
+        if self.targets is not None:
+            feed_dict[self.targets] = np.asarray(style_indices, dtype=np.int32)
+        elif any(style_index != self.style_index for style_index in style_indices):
+            raise ValueError("This graph only transfers style {}".format(self.style_index))
+        if self.learning_phase is not None:
+            feed_dict[self.learning_phase] = 0
+        output = self.session.run(self.output, feed_dict=feed_dict)
+        return [self.post_process_image(output[i][None, :, :, :].copy()) for i in range(len(output))]
+
+
+def psnr(reference, output):
+    mse = np.mean(np.square(reference.astype(np.float64) - output.astype(np.float64)))
+    return float("inf") if mse == 0 else 10.0 * np.log10(255.0 ** 2 / mse)
+
+
+def ssim(reference, output):
+    try:
+        from skimage.metrics import structural_similarity
+        return structural_similarity(reference, output, multichannel=True)
+    except ImportError:
+        from skimage.measure import compare_ssim
+        return compare_ssim(reference, output, multichannel=True)
+
+
+def measure(style_transfer, imgs, style_index, runs):
+    outputs = [style_transfer.transfer_batch(img, [style_index])[0] for img in imgs]  # also warms up
+    start = time.time()
+    for _ in range(runs):
+        [style_transfer.transfer_batch(img, [style_index]) for img in imgs]
+    return outputs, (time.time() - start) / (runs * len(imgs))
+
+
+def compare(checkpoint_path, export_dirs, image_paths, style_index, runs=3):
+    """
+    Report PSNR and SSIM against the float32 Keras model, and the latency per image,
+    of the exported graphs for all styles and for style_index alone (when it was exported).
+    """
+    reference = StyleTransfer(checkpoint_path)
+    imgs = [reference.load_image(path) for path in image_paths]
+    expected, elapsed = measure(reference, imgs, style_index, runs)
+    results = [("keras", float("inf"), 1.0, elapsed)]
+
+    for export_dir in export_dirs:
+        with open(os.path.join(export_dir, "export.json")) as f:
+            folded = style_index in json.load(f)["style_indices"]
+        for name, index in [("all styles", None)] + ([("folded", style_index)] if folded else []):
+            outputs, elapsed = measure(FrozenStyleTransfer(export_dir, index), imgs, style_index, runs)
+            results.append(("{} ({})".format(export_dir, name),
+                            np.mean([psnr(e, o) for e, o in zip(expected, outputs)]),
+                            np.mean([ssim(e, o) for e, o in zip(expected, outputs)]),
+                            elapsed))
+
+    for name, psnr_value, ssim_value, elapsed in results:
+        print("{:<48} PSNR {:>6.2f} dB  SSIM {:.4f}  {:.1f} ms/image".format(
+            name, psnr_value, ssim_value, elapsed * 1e3))
+    return results
+
+
+if __name__ == "__main__":
+    # python -m transfer.export <checkpoint> <export dir> [float32|float16|int8] [style index ...]
+    # python -m transfer.export compare <checkpoint> <style index> <image> [<image> ...] -- <export dir> ...
+    if sys.argv[1] == "compare":
+        separator = sys.argv.index("--")
+        compare(sys.argv[2], sys.argv[separator + 1:], sys.argv[4: separator], int(sys.argv[3]))
+    else:
+        export(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 and sys.argv[3] != "float32" else None,
+               [int(index) for index in sys.argv[4:]])
@@ -0,0 +1,138 @@
+from concurrent.futures import Future
+from collections import OrderedDict, defaultdict
+from itertools import count
+from threading import Lock, Thread
+import queue
+import time
+
+import numpy as np
+
+from transfer.tiling import split_tiles, blend_tiles
+
+
+class TransferScheduler(object):
+    """
+    Run concurrent style transfer requests through the network in batches.
+    A batch is collected for at most max_wait seconds or until it has max_batch images,
+    then its images are grouped by size and each group is stylized in runs of at most max_batch images.
+    Images larger than the tile size are split into tiles, which are batched like other images.
+
+    Background requests only run when no foreground request is waiting, one at a time,
+    so that a foreground request never waits for more than one background image.
+    They can be tagged, and cancelled by tag as long as they have not started.
+    """
+
+    _stop, _foreground, _background = -1, 0, 1
+
+    def __init__(self, style_transfer, max_batch=4, max_wait=0.05):
+        self.style_transfer = style_transfer
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.jobs = queue.PriorityQueue()
+        self.sequence = count()  # keeps the order of jobs with the same priority
+        self.tagged = defaultdict(set)
+        self.lock = Lock()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, imgs, style_indices, background=False, tag=None):
+        """
+        imgs are preprocessed images of shape (n, height, width, 3), with one style index each.
+        Returns a future of the list of stylized images.
+        """
+        future = Future()
+        if tag is not None:
+            with self.lock:
+                self.tagged[tag].add(future)
+            future.add_done_callback(lambda done: self.untag(tag, done))
+        priority = self._background if background else self._foreground
+        self.jobs.put((priority, next(self.sequence), (imgs, list(style_indices), future)))
+        return future
+
+    def untag(self, tag, future):
+        with self.lock:
+            self.tagged[tag].discard(future)
+            if not self.tagged[tag]:
+                del self.tagged[tag]
+
+    def cancel(self, tag):
+        with self.lock:
+            futures = list(self.tagged.get(tag, ()))
+        return sum(future.cancel() for future in futures)
+
+    def transfer_styles(self, input_path, style_indices, tile_size=None, overlap=32, max_dimension=None):
+        # the photo is loaded once (downscaled to max_dimension if given), and all its styles are submitted together
+        img = self.style_transfer.load_image(input_path, max_dimension)
+        height, width = img.shape[1:3]
+        if tile_size is None or max(height, width) <= tile_size:
+            return self.submit(np.repeat(img, len(style_indices), axis=0), style_indices).result()
+
+        tiles, positions = split_tiles(img, tile_size, overlap)
+        self.style_transfer.print_with_date("Split {} into {} tiles".format(input_path, len(tiles)))
+        # one job per style sharing the same tiles, rather than a copy of the tiles for each style
+        futures = [self.submit(tiles, [style_index] * len(tiles)) for style_index in style_indices]
+        return [blend_tiles(future.result(), positions, height, width, tile_size, overlap) for future in futures]
+
+    def collect(self, first_job):
+        batch, size = [first_job], len(first_job[0])
+        deadline = time.time() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                item = self.jobs.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item[0] != self._foreground:
+                # stop requests and background jobs are left for the next round
+                self.jobs.put(item)
+                break
+            batch.append(item[2])
+            size += len(item[2][0])
+        return batch
+
+    def run(self):
+        while True:
+            priority, _, job = self.jobs.get()
+            if priority == self._stop:
+                break
+
+            if priority == self._background:
+                self.run_batch([job])
+                continue
+
+            # images of different sizes cannot be stacked, so they are run as separate batches
+            buckets = OrderedDict()
+            for job in self.collect(job):
+                buckets.setdefault(job[0].shape[1:3], []).append(job)
+            for jobs in buckets.values():
+                self.run_batch(jobs)
+
+    def run_batch(self, jobs):
+        jobs = [job for job in jobs if job[2].set_running_or_notify_cancel()]
+        if not jobs:
+            return
+        try:
+            # (images, position, style index) of each image, only max_batch of them are stacked at a time,
+            # so that the input of a pass never grows with the number of images of the jobs
+            items = [(imgs, i, style_index) for imgs, indices, _ in jobs for i, style_index in enumerate(indices)]
+            self.style_transfer.print_with_date("Transfer a batch of {} images".format(len(items)))
+            # a single request may hold more than max_batch images, which are run in several passes
+            outputs = []
+            for start in range(0, len(items), self.max_batch):
+                passed = items[start: start + self.max_batch]
+                outputs += self.style_transfer.transfer_batch(np.stack([imgs[i] for imgs, i, _ in passed]),
+                                                              [style_index for _, _, style_index in passed])
+        except Exception as err:
+            [future.set_exception(err) for _, _, future in jobs]
+        else:
+            offset = 0
+            for imgs, _, future in jobs:
+                future.set_result(outputs[offset: offset + len(imgs)])
+                offset += len(imgs)
+
+    def shutdown(self):
+        # jobs still queued are dropped, background ones are the only ones left once requests are drained
+        self.jobs.put((self._stop, next(self.sequence), None))
+        self.thread.join()
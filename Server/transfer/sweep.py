@@ -0,0 +1,75 @@
+"""
+Sweep the threading configuration of style transfer on this machine.
+Each configuration runs in its own process, since TensorFlow sizes its thread pools once per process,
+and the process is bound to its cores before loading the model. Binding needs os.sched_setaffinity,
+which only Linux has, elsewhere the configurations with a number of cores are reported as unsupported. Requests are sent from several threads
+through a TransferScheduler, as the server does, and the throughput and latency percentiles are reported.
+
+python -m transfer.sweep <style index> <photo> [<photo> ...]
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# (intra_op_threads, inter_op_threads, number of cores), 0 threads lets TensorFlow pick one per core
+default_configs = [(0, 0, None), (1, 1, 1), (2, 1, 2), (4, 1, 4), (4, 2, 4), (8, 2, 8)]
+
+
+def run(intra_op_threads, inter_op_threads, num_cores, concurrency, num_requests, style_index, photo_paths):
+    # in the child process, prints the latency of each request as JSON
+    # sweep skips the configurations with a number of cores where processes cannot be bound
+    if num_cores is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, range(min(num_cores, os.cpu_count())))
+    from database import style_path
+    from transfer import StyleTransfer, TransferScheduler
+
+    style_transfer = StyleTransfer(style_path, intra_op_threads, inter_op_threads)
+    scheduler = TransferScheduler(style_transfer)
+    imgs = [style_transfer.load_image(path) for path in photo_paths]
+    [style_transfer.transfer_batch(img, [style_index]) for img in imgs]  # warm up
+
+    def request(i):
+        start = time.time()
+        scheduler.submit(imgs[i % len(imgs)], [style_index]).result()
+        return time.time() - start
+
+    start = time.time()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = list(executor.map(request, range(num_requests)))
+    elapsed = time.time() - start
+    scheduler.shutdown()
+    print(json.dumps({"elapsed": elapsed, "latencies": latencies}))
+
+
+def sweep(style_index, photo_paths, configs=default_configs, concurrency=4, num_requests=32):
+    results = []
+    for intra_op_threads, inter_op_threads, num_cores in configs:
+        if num_cores is not None and not hasattr(os, "sched_setaffinity"):
+            print("intra {:>2} inter {:>2} cores {:>4}  unsupported, processes cannot be bound to cores here".format(
+                intra_op_threads, inter_op_threads, num_cores))
+            continue
+        output = subprocess.check_output([sys.executable, "-m", "transfer.sweep", "run",
+                                          json.dumps([intra_op_threads, inter_op_threads, num_cores,
+                                                      concurrency, num_requests, style_index]),
+                                          *photo_paths])
+        # the model prints while loading, the measurements are on the last line
+        measured = json.loads(output.decode().strip().splitlines()[-1])
+        latencies = np.array(measured["latencies"])
+        throughput, p50, p99 = num_requests / measured["elapsed"], np.percentile(latencies, 50), np.percentile(latencies, 99)
+        results.append((intra_op_threads, inter_op_threads, num_cores, throughput, p50, p99))
+        print("intra {:>2} inter {:>2} cores {:>4}  {:6.2f} requests/s  p50 {:7.1f} ms  p99 {:7.1f} ms".format(
+            intra_op_threads, inter_op_threads, num_cores or "all", throughput, p50 * 1e3, p99 * 1e3))
+    return results
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "run":
+        run(*json.loads(sys.argv[2]), sys.argv[3:])
+    else:
+        sweep(int(sys.argv[1]), sys.argv[2:])
@@ -0,0 +1,49 @@
+"""
+Split large images into overlapping tiles for the pastiche net, and blend the stylized tiles back.
+The network memory then only depends on the tile size, while the seams between tiles are hidden
+by weighting each tile with a linear ramp over the overlap.
+"""
+
+import numpy as np
+
+
+def tile_starts(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    starts = list(range(0, length - tile_size, tile_size - overlap))
+    return starts + [length - tile_size]
+
+
+def split_tiles(img, tile_size, overlap):
+    """
+    img has shape (1, height, width, 3). Returns the tiles stacked as (n, tile_height, tile_width, 3),
+    where tiles are tile_size squares unless the image is smaller, and the (top, left) of each tile.
+    """
+    height, width = img.shape[1:3]
+    tile_height, tile_width = min(tile_size, height), min(tile_size, width)
+    positions = [(top, left)
+                 for top in tile_starts(height, tile_size, overlap)
+                 for left in tile_starts(width, tile_size, overlap)]
+    tiles = np.concatenate([img[:, top: top + tile_height, left: left + tile_width] for top, left in positions])
+    return tiles, positions
+
+
+def ramp(length, overlap):
+    distance = np.minimum(np.arange(1, length + 1), np.arange(length, 0, -1))
+    return np.minimum(distance / (overlap + 1.0), 1.0).astype(np.float32)
+
+
+def blend_tiles(tiles, positions, height, width, tile_size, overlap):
+    """
+    tiles are stylized uint8 images with the (top, left) given by split_tiles, the network may
+    output tiles slightly larger than its inputs, which are cropped. Returns a (height, width, 3) image.
+    """
+    tile_height, tile_width = min(tile_size, height), min(tile_size, width)
+    weight = np.outer(ramp(tile_height, overlap), ramp(tile_width, overlap))[:, :, None]
+
+    output = np.zeros((height, width, 3), dtype=np.float32)
+    weights = np.zeros((height, width, 1), dtype=np.float32)
+    for tile, (top, left) in zip(tiles, positions):
+        output[top: top + tile_height, left: left + tile_width] += tile[:tile_height, :tile_width] * weight
+        weights[top: top + tile_height, left: left + tile_width] += weight
+    return np.clip(np.round(output / weights), 0, 255).astype(np.uint8)
@@ -4,9 +4,11 @@ Use a trained pastiche net to stylize images.
 """
 
 import os
+import sys
 import time
 
 import numpy as np
+from PIL import Image
 import tensorflow as tf
 import keras.backend as kb
 from keras.preprocessing.image import load_img, img_to_array
@@ -17,11 +19,18 @@ import yaml
 from transfer.model import pastiche_model
 
 
+def session_config(intra_op_threads=0, inter_op_threads=0):
+    # 0 lets TensorFlow use as many threads as cores, which oversubscribes them with several processes per box
+    return tf.ConfigProto(device_count={"GPU": 0},
+                          intra_op_parallelism_threads=intra_op_threads,
+                          inter_op_parallelism_threads=inter_op_threads)
+
+
 class StyleTransfer(object):
-    def __init__(self, checkpoint_path):
-        config = tf.ConfigProto(device_count={"GPU": 0})
-        session = tf.Session(config=config)
-        kb.set_session(session)
+    def __init__(self, checkpoint_path, intra_op_threads=0, inter_op_threads=0):
+        config = session_config(intra_op_threads, inter_op_threads)
+        self.session = tf.Session(config=config)
+        kb.set_session(self.session)
         
         # Strip the extension if there is one
         checkpoint_path = os.path.splitext(checkpoint_path)[0]
@@ -38,9 +47,8 @@ class StyleTransfer(object):
         with h5py.File(checkpoint_path + ".h5", "r") as f:
             pastiche_net.load_weights_from_hdf5_group(f["model_weights"])
 
-        inputs = [pastiche_net.input, class_targets, kb.learning_phase()]
-
-        self.transfer_style = kb.function(inputs, [pastiche_net.output])
+        # run in this session rather than the Keras one, so that several models can be loaded side by side
+        self.pastiche_net, self.class_targets = pastiche_net, class_targets
     
     @staticmethod
     def post_process_image(img):
@@ -54,21 +62,35 @@ class StyleTransfer(object):
         img = np.clip(img, 0, 255).astype(np.uint8)
         return img
 
-    def __call__(self, input_path, output_path, style_index):
-        self.print_with_date("Processing {}".format(input_path))
-
+    @staticmethod
+    def load_image(input_path, max_dimension=None):
         img = load_img(input_path)
+        if max_dimension is not None:
+            # downscaled in place, keeping the aspect ratio
+            img.thumbnail((max_dimension, max_dimension), Image.ANTIALIAS)
         img = img_to_array(img)
         img = np.expand_dims(img, axis=0)
-        img = vgg16.preprocess_input(img)
+        return vgg16.preprocess_input(img)
+
+    def transfer_batch(self, imgs, style_indices):
+        """
+        Stylize preprocessed images of the same size in one run of the network.
+        imgs has shape (batch, height, width, 3), and style_indices one class target per image.
+        """
+        output = self.session.run(self.pastiche_net.output,
+                                  feed_dict={self.pastiche_net.input: imgs,
+                                             self.class_targets: np.asarray(style_indices, dtype=np.int32),
+                                             kb.learning_phase(): 0})
+        return [self.post_process_image(output[i][None, :, :, :].copy()) for i in range(len(output))]
 
-        indices = style_index + np.arange(1)
-        names = [self.style_names[style_index]]
-        style_name = names[0].decode("UTF-8")
+    def __call__(self, input_path, output_path, style_index):
+        self.print_with_date("Processing {}".format(input_path))
+
+        img = self.load_image(input_path)
+        style_name = self.style_names[style_index].decode("UTF-8")
         self.print_with_date("Using style {}".format(int(style_name)))
 
-        output = self.transfer_style([np.repeat(img, 1, axis=0), indices, 0.])[0]
-        output_img = self.post_process_image(output[0][None, :, :, :].copy())
+        output_img = self.transfer_batch(img, [style_index])[0]
         self.print_with_date("Transfer finished")
 
         return output_img
@@ -76,3 +98,33 @@ class StyleTransfer(object):
     @staticmethod
     def print_with_date(content):
         print("{} {}".format(time.asctime(), content))
+
+
+def benchmark_preview(checkpoint_path, image_paths, style_index, preview_size=256, preview_path=None, runs=3):
+    """
+    Compare the latency per photo of a full-size transfer with a preview of at most preview_size pixels,
+    stylized by the full model and, if preview_path is given, by a narrower model of the same styles.
+    """
+    def measure(style_transfer, max_dimension):
+        imgs = [style_transfer.load_image(path, max_dimension) for path in image_paths]
+        [style_transfer.transfer_batch(img, [style_index]) for img in imgs]  # warm up
+        start = time.time()
+        for _ in range(runs):
+            [style_transfer.transfer_batch(img, [style_index]) for img in imgs]
+        return (time.time() - start) / (runs * len(imgs))
+
+    style_transfer = StyleTransfer(checkpoint_path)
+    results = [("full size", measure(style_transfer, None)),
+               ("preview", measure(style_transfer, preview_size))]
+    if preview_path is not None:
+        results.append(("preview, narrow model", measure(StyleTransfer(preview_path), preview_size)))
+    for name, elapsed in results:
+        print("{:<24} {:8.1f} ms/photo  {:5.1f}x".format(name, elapsed * 1e3, results[0][1] / elapsed))
+    return results
+
+
+if __name__ == "__main__":
+    # python -m transfer.transfer <style index> <preview size> <photo> [<photo> ...]
+    from database import style_path, preview_path
+    benchmark_preview(style_path, sys.argv[3:], int(sys.argv[1]), int(sys.argv[2]),
+                      preview_path if os.path.isfile(preview_path) else None)